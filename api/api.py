@@ -1,8 +1,22 @@
 from contextlib import asynccontextmanager
 import logging
-from fastapi import FastAPI
+import secrets
+from fastapi import Depends, FastAPI, Header, HTTPException
+from fastapi.responses import StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
-from api.functions import *
+from api.config import get_config
+from api.functions import (
+    func_chat,
+    func_chat_stream,
+    func_close_mongo_connection,
+    func_create_chat_session,
+    func_delete_chat_session,
+    func_get_mongo_client,
+    func_get_session_history,
+    func_invalidate_credit_cache,
+    func_invalidate_student_cache,
+    func_list_all_sessions,
+)
 
 # Configure logging
 logging.basicConfig(
@@ -14,13 +28,19 @@ logger = logging.getLogger(__name__)
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     # Application start
-    func_get_mongo_client()
+    await func_get_mongo_client()
     
     yield # Application stop
-    func_close_mongo_connection()
+    await func_close_mongo_connection()
 
 app = FastAPI(title="Chatbot", lifespan=lifespan)
 
+def require_admin_key(x_admin_key: str = Header(default="")):
+    """Reject the request unless X-Admin-Key matches ADMIN_API_KEY (always, when it is unset)."""
+    admin_key = get_config()["ADMIN_API_KEY"]
+    if not admin_key or not secrets.compare_digest(x_admin_key, admin_key):
+        raise HTTPException(status_code=403, detail="Admin key required")
+
 # Allow CORS for frontend
 app.add_middleware(
     CORSMiddleware,
@@ -32,7 +52,7 @@ app.add_middleware(
 
 # Chat endpoint with RAG
 @app.post("/chat")
-def chat_endpoint(session_id: str, message: str):
+async def chat_endpoint(session_id: str, message: str):
     """
     Chat endpoint that processes user messages and returns bot responses.
     Inputs:
@@ -52,10 +72,27 @@ def chat_endpoint(session_id: str, message: str):
         ]
     }
     """
-    return func_chat(session_id, message)
+    return await func_chat(session_id, message)
+
+@app.post("/chat/stream")
+async def chat_stream_endpoint(session_id: str, message: str):
+    """
+    Streaming chat endpoint (Server-Sent Events).
+    Inputs:
+    {
+        "session_id": "string",
+        "message": "string"
+    }
+
+    Outputs (text/event-stream):
+    event: token    data: "string"  -> RAG answer chunk, repeated while generating
+    event: answer   data: "string"  -> final answer (replaces the tokens if the fallback was used)
+    event: history  data: [{"user": "string", "bot": "string", "timestamp": "datetime"}]
+    """
+    return StreamingResponse(func_chat_stream(session_id, message), media_type="text/event-stream")
 
 @app.get("/chat/history/{session_id}")
-def get_session_history(session_id: str, limit: int=100):
+async def get_session_history(session_id: str, limit: int=100):
     """
     Get chat history for a specific session.
     
@@ -77,10 +114,10 @@ def get_session_history(session_id: str, limit: int=100):
         ]
     }
     """
-    return func_get_session_history(session_id, limit)
+    return await func_get_session_history(session_id, limit)
 
 @app.get("/chat/sessions")
-def list_all_sessions(limit: int=10):
+async def list_all_sessions(limit: int=10):
     """
     List all chat sessions with their first message as preview.
 
@@ -103,10 +140,10 @@ def list_all_sessions(limit: int=10):
         ]
     }
     """
-    return func_list_all_sessions(limit)
+    return await func_list_all_sessions(limit)
 
 @app.delete("/chat/session/{session_id}")
-def delete_chat_session(session_id: str):
+async def delete_chat_session(session_id: str):
     """
     Delete all messages for a specific session.
 
@@ -121,10 +158,10 @@ def delete_chat_session(session_id: str):
         "message": "Session {session_id} deleted successfully" OR "Session {session_id} not found or could not be deleted"
     }
     """
-    return func_delete_chat_session(session_id)
+    return await func_delete_chat_session(session_id)
 
 @app.post("/chat/session/create")
-def create_chat_session():
+async def create_chat_session():
     """
     Create a new chat session and return its ID.
 
@@ -134,10 +171,45 @@ def create_chat_session():
         "session_id": "string" OR null
     }
     """
-    return func_create_chat_session()
+    return await func_create_chat_session()
+
+@app.delete("/student/{mssv}/cache", dependencies=[Depends(require_admin_key)])
+async def invalidate_student_cache(mssv: str):
+    """
+    Drop cached lookups for one student after their HOSOSINHVIEN record is updated.
+    Requires the X-Admin-Key header. Only the worker handling the request is cleared;
+    other workers pick the change up within STUDENT_CACHE_TTL (5 minutes).
+
+    Inputs:
+    {
+        "mssv": "string"
+    }
+
+    Outputs:
+    {
+        "success": bool,
+        "invalidated": int -> number of cached lookups removed
+    }
+    """
+    return func_invalidate_student_cache(mssv)
+
+@app.delete("/student/cache/credits", dependencies=[Depends(require_admin_key)])
+async def invalidate_credit_cache():
+    """
+    Drop cached credit lookups for every student after SOTINCHI is updated.
+    Requires the X-Admin-Key header. Only the worker handling the request is cleared;
+    other workers pick the change up within STUDENT_CACHE_TTL (5 minutes).
+
+    Outputs:
+    {
+        "success": bool,
+        "invalidated": int -> number of cached lookups removed
+    }
+    """
+    return func_invalidate_credit_cache()
 
 @app.get("/")
-def root():
+async def root():
     """Root endpoint to check if API is running."""
     return {"message": "Chatbot FastAPI backend is running with integrated chat and student APIs."}
 
@@ -1,9 +1,11 @@
 import os
+from functools import lru_cache
 from dotenv import load_dotenv
 from typing import Dict
 
 load_dotenv()
 
+@lru_cache(maxsize=1)
 def get_config():
 
     cfg = {
@@ -17,6 +19,14 @@ def get_config():
         # --- API Configuration ---
         "API_BASE_URL": os.getenv("API_BASE_URL", "http://localhost:8000"),
         "VITE_API_BASE_URL": os.getenv("VITE_API_BASE_URL", "http://localhost:8000"),
+
+        # --- Chat Configuration ---
+        # Number of past turns sent to RAG as conversation context
+        "RAG_HISTORY_TURNS": int(os.getenv("RAG_HISTORY_TURNS", "10")),
+
+        # --- Admin Configuration ---
+        # Required in the X-Admin-Key header by admin endpoints; unset disables them
+        "ADMIN_API_KEY": os.getenv("ADMIN_API_KEY", ""),
     }
 
     # --- Validation ---
@@ -1,35 +1,102 @@
 import os
+import asyncio
+import functools
+import inspect
+from cachetools import TTLCache
 from dotenv import load_dotenv
 from fastapi import HTTPException
-from pymongo import MongoClient, errors
-from pymongo.database import Database
+from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorDatabase
+from pymongo import ASCENDING, DESCENDING, IndexModel, InsertOne, MongoClient, UpdateOne, errors
 import logging
-from datetime import datetime
+from datetime import datetime, timezone
 
 load_dotenv()
 
 MONGO_URI = os.getenv("MONGODB_URI", "")
 DATABASE_NAME = os.getenv("MONGODB_DB_NAME", "chatbot_development")
 
+# Chat writes that queue up while a batch is in flight are written together, up to this many
+WRITE_BATCH_SIZE = 50
+# MongoClient.bulk_write (one command across collections) needs MongoDB 8.0+
+CLIENT_BULK_WRITE_WIRE_VERSION = 25
+
+# Chat history is cached per session. Each worker has its own cache, so a hit is only served
+# while the session's message_count still matches the one the cached history was read at
+HISTORY_CACHE_SIZE = 10_000
+HISTORY_CACHE_TTL = 60
+
+# Student records rarely change mid-session; call invalidate_student() / invalidate_credits()
+# after updates. Each API worker has its own cache, so stale entries elsewhere live out the TTL.
+STUDENT_CACHE_SIZE = 2048
+STUDENT_CACHE_TTL = 300
+# Cached lookups derived from SOTINCHI, which is keyed by class rather than by student
+CREDIT_LOOKUPS = ("get_student_total_credits", "get_student_credit_each_semester")
+
+def cached_student_lookup(method):
+    """Cache an async student lookup in self._student_cache, keyed by its arguments (MSSV first)."""
+    signature = inspect.signature(method)
+
+    @functools.wraps(method)
+    async def wrapper(self, *args, **kwargs):
+        # Bound by name, so positional and keyword calls share one entry
+        bound = signature.bind(self, *args, **kwargs)
+        bound.apply_defaults()
+        key = (method.__name__, *list(bound.arguments.values())[1:])
+        result = self._student_cache.get(key)
+        if result is None:
+            result = await method(self, *args, **kwargs)
+            self._student_cache[key] = result
+        return result
+    return wrapper
+
 class MongoManager:
-    client: MongoClient = None
-    db: Database = None
+    client: AsyncIOMotorClient = None
+    db: AsyncIOMotorDatabase = None
     chat_collection = None
+    sessions_collection = None
     hssv_collection = None
     stc_collection = None
+    _write_queue: asyncio.Queue = None
+    _writer_task: asyncio.Task = None
+    # Set at connect: the driver exposes client.bulk_write and the server is 8.0+ (wire version 25)
+    _client_bulk_write: bool = False
+
+    def __init__(self):
+        # session_id -> {"count": sessions.message_count it reflects, "by_limit": {limit: history}}
+        self._history_cache = TTLCache(maxsize=HISTORY_CACHE_SIZE, ttl=HISTORY_CACHE_TTL)
+        # session_id -> write events (bumped when a save starts and again when it is acknowledged);
+        # a history read that overlaps a save is not cached
+        self._history_writes = TTLCache(maxsize=HISTORY_CACHE_SIZE, ttl=HISTORY_CACHE_TTL)
+        # session_id -> saves not yet acknowledged
+        self._history_pending = {}
+        # (lookup name, mssv, *args) -> result
+        self._student_cache = TTLCache(maxsize=STUDENT_CACHE_SIZE, ttl=STUDENT_CACHE_TTL)
 
-    def get_mongo_client(self, path=MONGO_URI):
+    async def get_mongo_client(self, path=MONGO_URI):
         """Establish and return a MongoDB client."""
         try:
-            self.client = MongoClient(path)
+            # Keep a few connections warm; zstd compresses wire traffic (embedding arrays especially).
+            # tz_aware: timestamps read back are UTC-aware, like the ones cached on save
+            self.client = AsyncIOMotorClient(
+                path, maxPoolSize=100, minPoolSize=10, compressors="zstd", tz_aware=True
+            )
             self.db = self.client[DATABASE_NAME]
-            # Test the connection
-            self.client.admin.command('ping')
+            # Test the connection; hello also reports the server's wire version
+            hello = await self.client.admin.command('hello')
+            self._client_bulk_write = (
+                hello.get("maxWireVersion", 0) >= CLIENT_BULK_WRITE_WIRE_VERSION
+                and getattr(type(self.client), "bulk_write", None) is not None
+            )
             logging.info("Connected to MongoDB successfully.")
-            self.get_collections()
+            await self.get_collections()
         except errors.ConnectionFailure as e:
-            logging.error(f"ERROR CONNECTING TO MONGODB: Please check MONGO_URI and Access List. Details: {e}")
+            logging.error("ERROR CONNECTING TO MONGODB: Please check MONGO_URI and Access List. Details: %s", e)
             return None
+
+    @property
+    def sync_client(self) -> MongoClient:
+        """Underlying pymongo client, for libraries (e.g. LangChain vector stores) that need sync collections."""
+        return self.client.delegate if self.client else None
         
     def close_connection(self):
         """Close the MongoDB client connection."""
@@ -37,80 +104,262 @@ class MongoManager:
         if self.client:
             self.client.close()
 
-    def get_collections(self):
+    def start_writer(self):
+        """Start the background task that batches chat message writes."""
+        self._write_queue = asyncio.Queue()
+        self._writer_task = asyncio.create_task(self._run_writer())
+
+    async def flush(self):
+        """Write out every queued chat message and stop the background writer."""
+        if self._writer_task is None:
+            return
+        self._write_queue.put_nowait(None)
+        await self._writer_task
+        self._writer_task = None
+        self._write_queue = None
+
+    async def _run_writer(self):
+        """
+        Drain the write queue as a group commit: each batch is whatever is already queued
+        (up to WRITE_BATCH_SIZE), written at once, and every waiting caller gets the result.
+        """
+        stopping = False
+        while not stopping:
+            item = await self._write_queue.get()
+            if item is None:
+                break
+            batch = [item]
+            while len(batch) < WRITE_BATCH_SIZE:
+                try:
+                    item = self._write_queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+            saved = await self._write_batch([message for message, _ in batch])
+            for _, done in batch:
+                if not done.done():
+                    done.set_result(saved)
+
+    async def _write_batch(self, batch: list) -> bool:
+        """Insert a batch of chat messages and update their sessions. Returns True once acknowledged."""
+        # One session update per session in the batch, however many turns it has
+        sessions = {}
+        for message in batch:
+            session = sessions.setdefault(message["session_id"], {"first": message, "count": 0})
+            session["last"] = message
+            session["count"] += 1
+
+        def session_update(session_id, session, **kwargs):
+            return UpdateOne(
+                {"_id": session_id},
+                {
+                    "$setOnInsert": {
+                        "first_message": session["first"]["user_message"],
+                        "first_timestamp": session["first"]["timestamp"]
+                    },
+                    "$set": {"last_timestamp": session["last"]["timestamp"]},
+                    "$inc": {"message_count": session["count"]}
+                },
+                upsert=True,
+                **kwargs
+            )
+
+        try:
+            if self._client_bulk_write:
+                try:
+                    # Both collections in a single round trip (MongoDB 8.0+)
+                    # Ordered, so a session's message_count never counts a turn before it is readable
+                    await self.client.bulk_write(
+                        [InsertOne(message, namespace=self.chat_collection.full_name) for message in batch]
+                        + [session_update(session_id, session, namespace=self.sessions_collection.full_name)
+                           for session_id, session in sessions.items()],
+                        ordered=True
+                    )
+                    return True
+                except (TypeError, errors.InvalidOperation) as e:
+                    # TypeError: Motor resolves an unknown attribute to a database, which isn't callable
+                    logging.warning("Client bulk write unavailable, using per-collection writes: %s", e)
+                    self._client_bulk_write = False
+
+            await self.chat_collection.insert_many(batch, ordered=False)
+            await self.sessions_collection.bulk_write([
+                session_update(session_id, session)
+                for session_id, session in sessions.items()
+            ], ordered=False)
+            return True
+        except Exception as e:
+            logging.error("Error saving %s chat messages: %s", len(batch), e)
+            return False
+
+    async def get_collections(self):
         """Get the chat history collection."""
         self.chat_collection = self.db.get_collection("chat_history")
+        self.sessions_collection = self.db.get_collection("sessions")
         self.hssv_collection = self.db.get_collection("HOSOSINHVIEN")
         self.stc_collection = self.db.get_collection("SOTINCHI")
 
         logging.info("Collections accessed.")
 
-    def save_chat_message(self, session_id: str, user_message: str, bot_response: str):
+    async def setup_schema(self):
+        """Create indexes and backfill sessions. Run by the API at startup, not by scripts."""
+        if self.chat_collection is None:
+            return
+        await self.ensure_indexes()
+        await self.backfill_sessions()
+
+    async def ensure_indexes(self):
+        """Create the indexes backing the chat and student lookups (no-op if they exist)."""
+        indexes = [
+            # Covers get_chat_history's find(session_id).sort(timestamp desc)
+            (self.chat_collection, [IndexModel([("session_id", ASCENDING), ("timestamp", DESCENDING)])]),
+            (self.sessions_collection, [IndexModel([("last_timestamp", DESCENDING)])]),
+            (self.hssv_collection, [IndexModel([("MASV", ASCENDING)], unique=True)]),
+            # The MALOP prefix also serves the class-only lookup in get_student_total_credits
+            (self.stc_collection, [IndexModel([("MALOP", ASCENDING), ("NAM", ASCENDING), ("HK", ASCENDING)])]),
+        ]
+        for collection, models in indexes:
+            try:
+                await collection.create_indexes(models)
+            except errors.OperationFailure as e:
+                logging.error("Error creating indexes on %s: %s", collection.name, e)
+
+    async def backfill_sessions(self):
+        """Build the sessions collection from chat_history if it has never been populated."""
+        if await self.sessions_collection.estimated_document_count() > 0:
+            return
+        if await self.chat_collection.estimated_document_count() == 0:
+            return
+
+        logging.info("Backfilling sessions collection from chat_history...")
+        await self.chat_collection.aggregate([
+            {"$sort": {"timestamp": 1}},
+            {"$group": {
+                "_id": "$session_id",
+                "first_message": {"$first": "$user_message"},
+                "first_timestamp": {"$first": "$timestamp"},
+                "last_timestamp": {"$last": "$timestamp"},
+                "message_count": {"$sum": 1}
+            }},
+            {"$merge": {"into": "sessions", "whenMatched": "keepExisting"}}
+        ]).to_list(None)
+
+    async def save_chat_message(self, session_id: str, user_message: str, bot_response: str):
         """Save a chat message to the database."""
         if self.chat_collection is None:
             logging.warning("Warning: Could not save chat message - database connection failed")
             return False
         
+        message = {
+            "session_id": session_id,
+            "user_message": user_message,
+            "bot_response": bot_response,
+            "timestamp": datetime.now(timezone.utc)
+        }
+        self._begin_history_write(session_id)
+        self._cache_turn(message)
         try:
-            self.chat_collection.insert_one({
-                "session_id": session_id,
-                "user_message": user_message,
-                "bot_response": bot_response,
-                "timestamp": datetime.utcnow()
-            })
-            return True
-        except Exception as e:
-            logging.error(f"Error saving chat message: {e}")
-            return False
+            # Without a running writer (e.g. standalone scripts) write straight through
+            if self._write_queue is None:
+                saved = await self._write_batch([message])
+            else:
+                # Wait for the acknowledged batch write, so reads after /chat returns see this turn
+                done = asyncio.get_running_loop().create_future()
+                self._write_queue.put_nowait((message, done))
+                saved = await done
+        finally:
+            self._end_history_write(session_id)
+        if not saved:
+            self._history_cache.pop(session_id, None)
+        return saved
+
+    def _bump_history_writes(self, session_id: str):
+        self._history_writes[session_id] = self._history_writes.get(session_id, 0) + 1
 
-    def get_chat_history(self, session_id: str, limit: int = 100):
+    def _begin_history_write(self, session_id: str):
+        self._history_pending[session_id] = self._history_pending.get(session_id, 0) + 1
+        self._bump_history_writes(session_id)
+
+    def _end_history_write(self, session_id: str):
+        # Bumped again once acknowledged, so a read spanning any part of the write sees a change
+        self._bump_history_writes(session_id)
+        pending = self._history_pending.pop(session_id, 0) - 1
+        if pending > 0:
+            self._history_pending[session_id] = pending
+
+    def _cache_turn(self, message: dict):
+        """Append a new turn to the session's cached histories, keeping each within its limit."""
+        cached = self._history_cache.get(message["session_id"])
+        if not cached:
+            return
+        cached["count"] += 1
+        turn = {
+            "user": message["user_message"],
+            "bot": message["bot_response"],
+            "timestamp": message["timestamp"]
+        }
+        # New lists rather than append(): callers may still hold the old ones
+        by_limit = cached["by_limit"]
+        for limit, history in list(by_limit.items()):
+            by_limit[limit] = (history + [turn])[-limit:] if limit else history + [turn]
+
+    async def get_chat_history(self, session_id: str, limit: int = 100):
         """Retrieve chat history for a session."""
         if self.chat_collection is None:
             return []
-        
+
+        writes = self._history_writes.get(session_id, 0)
+        # A read that starts while a save is unacknowledged may or may not see that turn
+        writing = session_id in self._history_pending
         try:
-            messages = list(self.chat_collection.find(
-                {"session_id": session_id}
-            ).sort("timestamp", -1).limit(limit))
-            
-            # Reverse to get chronological order
-            messages.reverse()
+            # Another worker may have saved turns since this one cached the history
+            count = await self._session_message_count(session_id)
+            cached = self._history_cache.get(session_id)
+            if cached is not None and cached["count"] == count and limit in cached["by_limit"]:
+                return cached["by_limit"][limit]
+
+            messages = await self.chat_collection.find(
+                {"session_id": session_id},
+                {"user_message": 1, "bot_response": 1, "timestamp": 1, "_id": 0}
+            ).sort("timestamp", -1).limit(limit).to_list(limit)
             
-            return [
+            # Newest-first from the query; reversed() yields chronological order in the same pass
+            history = [
                 {
                     "user": msg["user_message"],
                     "bot": msg["bot_response"],
                     "timestamp": msg["timestamp"]
                 }
-                for msg in messages
+                for msg in reversed(messages)
             ]
+            # A turn saved while this query ran may be missing from it; don't cache that
+            if not writing and self._history_writes.get(session_id, 0) == writes:
+                if cached is None or cached["count"] != count:
+                    cached = self._history_cache[session_id] = {"count": count, "by_limit": {}}
+                cached["by_limit"][limit] = history
+            return history
         except Exception as e:
-            logging.error(f"Error retrieving chat history: {e}")
+            logging.error("Error retrieving chat history: %s", e)
             return []
 
-    def get_all_sessions(self, limit: int = 50):
+    async def _session_message_count(self, session_id: str) -> int:
+        """Turns saved to a session as recorded in sessions (a single _id lookup)."""
+        doc = await self.sessions_collection.find_one({"_id": session_id}, {"message_count": 1})
+        return doc["message_count"] if doc else 0
+
+    async def get_all_sessions(self, limit: int = 50):
         """Retrieve all unique chat sessions with their first message as preview."""
-        if self.chat_collection is None:
+        if self.sessions_collection is None:
             logging.warning("Warning: Could not retrieve sessions - database connection failed")
             return []
         
         try:
-            # Aggregation pipeline to get unique sessions with metadata
-            pipeline = [
-                {"$sort": {"timestamp": 1}},
-                {"$group": {
-                    "_id": "$session_id",
-                    "first_message": {"$first": "$user_message"},
-                    "first_timestamp": {"$first": "$timestamp"},
-                    "last_timestamp": {"$last": "$timestamp"},
-                    "message_count": {"$sum": 1}
-                }},
-                {"$sort": {"last_timestamp": -1}},
-                {"$limit": limit}
-            ]
-            
-            sessions = list(self.chat_collection.aggregate(pipeline))
-            logging.info(f"Retrieved {len(sessions)} sessions from database.")
+            sessions = await self.sessions_collection.find().sort(
+                "last_timestamp", -1
+            ).limit(limit).to_list(limit)
+            logging.info("Retrieved %s sessions from database.", len(sessions))
 
             return [
                 {
@@ -123,69 +372,102 @@ class MongoManager:
                 for session in sessions
             ]
         except Exception as e:
-            logging.error(f"Error retrieving sessions: {e}")
+            logging.error("Error retrieving sessions: %s", e)
             return []
 
-    def delete_session(self, session_id: str):
+    async def delete_session(self, session_id: str):
         """Delete all messages for a specific session."""
         if self.chat_collection is None:
             logging.warning("Warning: Could not delete session - database connection failed")
             return False
         
         try:
-            result = self.chat_collection.delete_many({"session_id": session_id})
+            result = await self.chat_collection.delete_many({"session_id": session_id})
+            await self.sessions_collection.delete_one({"_id": session_id})
+            self._history_cache.pop(session_id, None)
             return result.deleted_count > 0
         except Exception as e:
-            logging.error(f"Error deleting session: {e}")
+            logging.error("Error deleting session: %s", e)
             return False
         
-    def session_exists(self, session_id: str):
+    async def session_exists(self, session_id: str):
         """Check if a session ID already exists in the database."""
         if self.chat_collection is None:
             return False
         
         try:
-            count = self.chat_collection.count_documents({"session_id": session_id})
-            return count > 0
+            # Stops at the first (session_id, timestamp) index hit instead of counting
+            doc = await self.chat_collection.find_one({"session_id": session_id}, projection={"_id": 1})
+            return doc is not None
         except Exception as e:
-            logging.error(f"Error checking session existence: {e}")
+            logging.error("Error checking session existence: %s", e)
             return False
     
     def serialize(doc):
         doc['_id'] = str(doc['_id'])
         return doc
 
-    def get_student_data(self, mssv: str):
-        doc = self.hssv_collection.find_one({"MASV": mssv})
+    def _invalidate_student_keys(self, match) -> int:
+        keys = [key for key in list(self._student_cache.keys()) if match(key)]
+        for key in keys:
+            self._student_cache.pop(key, None)
+        return len(keys)
+
+    def invalidate_student(self, mssv: str):
+        """Drop this process's cached lookups for one student. Returns the number of entries removed."""
+        # The chatbot flow always looks students up by the upper-cased MSSV
+        mssv = mssv.upper()
+        return self._invalidate_student_keys(lambda key: key[1] == mssv)
+
+    def invalidate_credits(self):
+        """Drop this process's cached SOTINCHI-derived lookups for every student (after a class's credits change)."""
+        return self._invalidate_student_keys(lambda key: key[0] in CREDIT_LOOKUPS)
+
+    @cached_student_lookup
+    async def get_student_data(self, mssv: str):
+        doc = await self.hssv_collection.find_one({"MASV": mssv})
         if not doc:
             raise Exception(f"Không tìm thấy sinh viên {mssv}")
         doc["_id"] = str(doc["_id"])
         return doc
 
-    def get_student_total_credits(self, mssv: str):
-        student = self.hssv_collection.find_one({"MASV": mssv})
+    @cached_student_lookup
+    async def get_student_total_credits(self, mssv: str):
+        student = await self.hssv_collection.find_one({"MASV": mssv})
         if not student:
             raise HTTPException(status_code=404, detail="Student not found")
         class_code = student.get("MALOP", "")
         if not class_code:
             raise HTTPException(status_code=400, detail="Class code not found")
-        all_student_classcodes = list(self.stc_collection.find({"MALOP": class_code}))
-        total_course_credits = sum(doc.get("STC", 0) for doc in all_student_classcodes)
+        # Sum and collect the courses server-side instead of shipping whole documents
+        totals = await self.stc_collection.aggregate([
+            {"$match": {"MALOP": class_code}},
+            {"$group": {
+                "_id": None,
+                "total": {"$sum": "$STC"},
+                "subjects": {"$push": {
+                    "MSMH": {"$ifNull": ["$MSMH", ""]},
+                    "STC": {"$ifNull": ["$STC", 0]}
+                }}
+            }}
+        ]).to_list(1)
+        total = totals[0] if totals else {"total": 0, "subjects": []}
         return {
             "MASV": mssv,
             "MALOP": class_code,
-            "TONGTINCHI": total_course_credits,
-            "MONHOC": [{"MSMH": doc.get("MSMH", ""), "STC": doc.get("STC", 0)} for doc in all_student_classcodes]
+            "TONGTINCHI": total["total"],
+            "MONHOC": total["subjects"]
         }
 
-    def get_student_credit_each_semester(self, mssv: str, hk: str, nam: str): 
-        student = self.hssv_collection.find_one({"MASV": mssv})
+    @cached_student_lookup
+    async def get_student_credit_each_semester(self, mssv: str, hk: str, nam: str): 
+        student = await self.hssv_collection.find_one({"MASV": mssv})
         if not student:
             raise HTTPException(status_code=404, detail="Not found student data")
         malop = student.get("MALOP")
         if not malop:
             raise HTTPException(status_code=400, detail="Not found MALOP")
-        student_docs = list(self.stc_collection.find({"MALOP": malop, "NAM": nam, "HK": hk}))
+        student_docs = await self.stc_collection.find({"MALOP": malop, "NAM": nam, "HK": hk}).to_list(None)
         if not student_docs:
             raise HTTPException(status_code=404, detail="Not found data TINCHI")
         tong_tinchi = sum(doc.get("STC", 0) for doc in student_docs)
@@ -196,4 +478,4 @@ class MongoManager:
             "NAM": nam,
             "TONGTINCHI": tong_tinchi,
             "MON_HOC": [{"MAMH": doc.get("MSMH", ""), "STC": doc.get("STC", 0)} for doc in student_docs]
-            }
\ No newline at end of file
+            }
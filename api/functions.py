@@ -1,62 +1,86 @@
+import asyncio
+import json
 import logging
+from api.config import get_config
 from api.db import db
 from api.llm import llm
-from api.langgraph.flow import run_chatbot
-from api.rag.chat_session import *
+from api.rag.chat_session_update import aask, astream_answer_query
 import uuid
 
 # =============================== RAG ===============================
-def func_rag(message: str, history: list):
+async def func_rag(message: str, history: list):
     try:
-        answer = ask(message, history)
+        answer = await aask(message, history)
         
         return answer
     except Exception as e:
-        logging.error(f"RAG Error: {e}")
+        logging.error("RAG Error: %s", e)
         return f"Error: {e}"
 
 # =============================== Langgraph ==============================
-def func_run_langgraph(query: str):
-    return run_chatbot(query)
+async def func_run_langgraph(query: str):
+    # Imported on first use, so the graph is built on the first chat turn rather than at startup
+    from api.langgraph.flow import run_chatbot
+    return await run_chatbot(query)
 
 # =============================== Chat functions ===============================
 
-def func_chat(session_id: str, message: str):
-    logging.info("Calling RAG...")
-    # RAG integration
-    history = func_get_session_history(session_id).get("history", [])
-    rag_answer = func_rag(message, history)
-    
-    # Use orchestration agent to evaluate RAG response
+async def func_orchestrate(message: str, rag_answer: str):
+    """
+    Decide between the RAG answer and the LangGraph fallback for a user message.
+    """
+    from api.langgraph.flow import has_student_id
+
+    # Use orchestration agent to evaluate RAG response. A message naming an MSSV runs
+    # the LangGraph fallback speculatively alongside it, so a fallback costs max() not
+    # sum(); without an MSSV the fallback has no student to look up, and starting it
+    # would only pay for an intent-classify call that then gets cancelled.
     logging.info("Evaluating RAG response with orchestration agent...")
-    evaluation = llm.evaluate_rag_response(message, rag_answer)
+    langgraph_task = None
+    if has_student_id(message):
+        langgraph_task = asyncio.create_task(func_run_langgraph(message))
+    try:
+        evaluation = await llm.aevaluate_rag_response(message, rag_answer)
+    except BaseException:
+        if langgraph_task:
+            langgraph_task.cancel()
+        raise
     
-    logging.info(f"[Orchestration] is_sufficient={evaluation['is_sufficient']}, "
-                 f"needs_student_data={evaluation['needs_student_data']}, "
-                 f"reason={evaluation['reason']}")
+    logging.info("[Orchestration] is_sufficient=%s, needs_student_data=%s, reason=%s",
+                 evaluation['is_sufficient'], evaluation['needs_student_data'], evaluation['reason'])
     
     # Decide whether to use RAG answer or fallback to LangGraph
     if evaluation['is_sufficient'] and not evaluation['needs_student_data']:
-        answer = rag_answer
-    else:
-        logging.info("Triggering fallback LangGraph...")
-        try:
-            fallback = func_run_langgraph(message)
-            # If LangGraph provides a meaningful response, use it
-            # Otherwise, fall back to RAG answer (even if incomplete)
-            if fallback and fallback.strip() and "Error" not in fallback:
-                answer = fallback
-                logging.info("Using LangGraph response.")
-            else:
-                answer = rag_answer  # Use RAG even if not perfect
-                logging.info("Using RAG response.")
-        except Exception as e:
-            logging.error(f"LangGraph fallback error: {e}")
-            answer = rag_answer  # Use RAG answer on error
-            logging.info("Using RAG response due to LangGraph error.")
+        if langgraph_task:
+            langgraph_task.cancel()
+        return rag_answer
+
+    logging.info("Triggering fallback LangGraph...")
+    try:
+        fallback = await (langgraph_task or func_run_langgraph(message))
+        # If LangGraph provides a meaningful response, use it
+        # Otherwise, fall back to RAG answer (even if incomplete)
+        if fallback and fallback.strip() and "Error" not in fallback:
+            logging.info("Using LangGraph response.")
+            return fallback
+        logging.info("Using RAG response.")
+        return rag_answer  # Use RAG even if not perfect
+    except Exception as e:
+        logging.error("LangGraph fallback error: %s", e)
+        logging.info("Using RAG response due to LangGraph error.")
+        return rag_answer  # Use RAG answer on error
+
+async def func_chat(session_id: str, message: str):
+    logging.info("Calling RAG...")
+    # RAG integration
+    history_turns = get_config()["RAG_HISTORY_TURNS"]
+    history = (await func_get_session_history(session_id, limit=history_turns)).get("history", [])
+    rag_answer = await func_rag(message, history)
+    
+    answer = await func_orchestrate(message, rag_answer)
 
     # Save chat message to database
-    func_save_chat_message(session_id, message, answer)       
+    await func_save_chat_message(session_id, message, answer)       
     # History is already in correct format from db.get_chat_history
     # Each item is {"user": ..., "bot": ..., "timestamp": ...}
     return {
@@ -64,24 +88,62 @@ def func_chat(session_id: str, message: str):
         "history": history
     }
 
+def _sse(event: str, data) -> str:
+    """Format one server-sent event with a JSON payload."""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False, default=str)}\n\n"
+
+async def func_chat_stream(session_id: str, message: str):
+    """
+    Streaming variant of func_chat, yielding server-sent events:
+    "token" chunks of the RAG answer as Gemini produces them, then the final
+    "answer" (which replaces the tokens when the LangGraph fallback is used),
+    then "history".
+    """
+    logging.info("Calling RAG (streaming)...")
+    history_turns = get_config()["RAG_HISTORY_TURNS"]
+    history = (await func_get_session_history(session_id, limit=history_turns)).get("history", [])
+
+    chunks = []
+    try:
+        stream, _ = await astream_answer_query(message, history)
+        async for chunk in stream:
+            chunks.append(chunk)
+            yield _sse("token", chunk)
+    except Exception as e:
+        logging.error("RAG Error: %s", e)
+        chunks.append(f"Error: {e}")
+        yield _sse("token", chunks[-1])
+    rag_answer = "".join(chunks).strip()
+
+    # Evaluate and save only once the whole RAG answer has been streamed
+    answer = await func_orchestrate(message, rag_answer)
+    yield _sse("answer", answer)
+
+    await func_save_chat_message(session_id, message, answer)
+    yield _sse("history", history)
+
 # ===============================MongoDB functions===============================
 
-def func_get_mongo_client():
+async def func_get_mongo_client():
     """ Get MongoDB client info """
     try:
-        client_info = db.get_mongo_client()
+        client_info = await db.get_mongo_client()
+        # Schema setup writes (indexes, sessions backfill), so only the API does it
+        await db.setup_schema()
+        db.start_writer()
         return client_info
     except Exception as e:
-        logging.error(f"Error: {e}")
+        logging.error("Error: %s", e)
         return None
     
-def func_close_mongo_connection():
+async def func_close_mongo_connection():
     """ Close MongoDB connection """
     try:
+        await db.flush()
         db.close_connection()
         return {"success": True}
     except Exception as e:
-        logging.error(f"Error: {e}")
+        logging.error("Error: %s", e)
         return {"success": False, "error": str(e)}
 
 def func_summarize_response(content):
@@ -101,39 +163,39 @@ def func_show_callbacks():
     except Exception as e:
         return {"Error": str(e)}
 
-def func_get_session_history(session_id: str, limit: int = 100):
+async def func_get_session_history(session_id: str, limit: int = 100):
     """
     Retrieve chat history for a specific session from database.
     """
     try:
-        history = db.get_chat_history(session_id, limit)
+        history = await db.get_chat_history(session_id, limit)
         return {"session_id": session_id, "history": history}
     except Exception as e:
-        logging.error(f"Error: {e}")
+        logging.error("Error: %s", e)
         return {"session_id": session_id, "history": []}
 
-def func_list_all_sessions(limit: int = 50):
+async def func_list_all_sessions(limit: int = 50):
     """
     List all chat sessions with metadata.
     Returns session_id, first message preview, timestamps, and message count.
     """
     try:
-        sessions_list = db.get_all_sessions(limit)
+        sessions_list = await db.get_all_sessions(limit)
 
     except Exception as e:
-        logging.error(f"Error: {e}")
+        logging.error("Error: %s", e)
 
     return {
         "total": len(sessions_list),
         "sessions": sessions_list
     }
 
-def func_delete_chat_session(session_id: str):
+async def func_delete_chat_session(session_id: str):
     """
     Delete all messages for a specific session.
     """
     try:
-        success = db.delete_session(session_id)
+        success = await db.delete_session(session_id)
         if success:
             return {
                 "success": True,
@@ -141,42 +203,63 @@ def func_delete_chat_session(session_id: str):
             }
       
     except Exception as e:
-        logging.error(f"Error deleting session {session_id}: {e}")    
+        logging.error("Error deleting session %s: %s", session_id, e)    
         return {
             "success": False,
             "message": f"Session {session_id} not found or could not be deleted"
         }
     
-def func_create_chat_session():
+async def func_create_chat_session():
     """
     Create a new chat session and return its ID.
     """
     try:
+        # UUIDv4 collisions are negligible, so no database round trip is needed
         session_id = str(uuid.uuid4())
-        while db.session_exists(session_id):
-            session_id = str(uuid.uuid4())
         return {
             "success": True,
             "session_id": session_id
         }
     except Exception as e:
-        logging.error(f"Error creating chat session: {e}")
+        logging.error("Error creating chat session: %s", e)
         return {
             "success": False,
             "session_id": None
         }
         
-def func_save_chat_message(session_id: str, user_message: str, bot_response: str):
+def func_invalidate_student_cache(mssv: str):
+    """
+    Drop this worker's cached lookups for a student after their HOSOSINHVIEN data changes.
+    """
+    try:
+        removed = db.invalidate_student(mssv)
+        return {"success": True, "invalidated": removed}
+    except Exception as e:
+        logging.error("Error invalidating student cache %s: %s", mssv, e)
+        return {"success": False, "invalidated": 0}
+
+def func_invalidate_credit_cache():
+    """
+    Drop this worker's cached credit lookups for every student after SOTINCHI changes.
+    """
+    try:
+        removed = db.invalidate_credits()
+        return {"success": True, "invalidated": removed}
+    except Exception as e:
+        logging.error("Error invalidating credit cache: %s", e)
+        return {"success": False, "invalidated": 0}
+
+async def func_save_chat_message(session_id: str, user_message: str, bot_response: str):
     """
     Save a chat message to the database.
     """
     try:
-        success = db.save_chat_message(session_id, user_message, bot_response)
+        success = await db.save_chat_message(session_id, user_message, bot_response)
         if success:
             return {"success": True}
         else:
             return {"success": False}
     except Exception as e:
-        logging.error(f"Error saving chat message: {e}")
+        logging.error("Error saving chat message: %s", e)
         return {"success": False}
     
\ No newline at end of file
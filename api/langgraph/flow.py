@@ -25,6 +25,20 @@ INTENT_MAP = {
     "student_lesson": "tra cứu lịch học của sinh viên"
 }
 
+# Precompiled patterns used on every query
+_CLEAN_RE = re.compile(r"[^a-zA-Z0-9áàảãạâấầẩẫậăắằẳẵặđéèẻẽẹêếềểễệíìỉĩịòóỏõọôốồổỗộơớờởỡợúùủũụưứừửữựýỳỷỹỵ\s]")
+_WS_RE = re.compile(r"\s+")
+_MSSV_RE = re.compile(r"\bK\d{9}\b", re.IGNORECASE)
+
+# Keyword rules tried in order before falling back to the LLM router.
+# Credit questions often name a semester ("tín chỉ học kỳ 1"), so student_credit comes first,
+# and bare semester wording is left to the LLM: the lesson handler cannot extract hk/nam yet.
+INTENT_RULES = [
+    ("student_credit", re.compile(r"tín chỉ|tin chi|môn học|mon hoc")),
+    ("student_lesson", re.compile(r"lịch học|lich hoc|thời khóa biểu|thời khoá biểu|thoi khoa bieu")),
+    ("student_info", re.compile(r"thông tin|thong tin|hồ sơ|ho so|lý lịch|ly lich")),
+]
+
 # Graph nodes
 def get_user_input(state: StateAgent) -> StateAgent:
     """Initial node: receive raw user query."""
@@ -39,9 +53,8 @@ def get_user_input(state: StateAgent) -> StateAgent:
 def preprocess_query(state: StateAgent) -> StateAgent:
     """Clean user query by removing unwanted characters."""
     try:
-        q = re.sub(r"[^a-zA-Z0-9áàảãạâấầẩẫậăắằẳẵặđéèẻẽẹêếềểễệíìỉĩịòóỏõọôốồổỗộơớờởỡợúùủũụưứừửữựýỳỷỹỵ\s]", "",
-                   state['query'])
-        q = re.sub(r"\s+", " ", q).strip()
+        q = _CLEAN_RE.sub("", state['query'])
+        q = _WS_RE.sub(" ", q).strip()
         state['cleaned_query'] = q
         state['bot_reply'] = f"Nội dung đã làm sạch:\n{q}"
     except Exception as e:
@@ -50,13 +63,9 @@ def preprocess_query(state: StateAgent) -> StateAgent:
         state['bot_reply'] = f"Error while cleaning query: {e}"
     return state
 
-# Identify content api route
-def classify_intent(state: StateAgent) -> StateAgent:
-    """Use Gemini to classify user intent based on the query."""
-    try:
-        q = state["cleaned_query"]
-
-        system_prompt = f"""
+# Everything in the router prompt before the user query, built once at import
+_INTENT_MAP_JSON = json.dumps(INTENT_MAP, ensure_ascii=False, indent=2)
+_INTENT_PROMPT_PREFIX = f"""
         [ROLE]
         Bạn là bộ phân loại ý định (Intent Router) của hệ thống chatbot đại học.
 
@@ -64,7 +73,7 @@ def classify_intent(state: StateAgent) -> StateAgent:
         Phân loại câu hỏi người dùng vào **duy nhất một** trong các nhóm ý định sau.
 
         [INTENT MAP]
-        {json.dumps(INTENT_MAP, ensure_ascii=False, indent=2)}
+        {_INTENT_MAP_JSON}
 
         [INSTRUCTION]
         - Chỉ được chọn **một key hợp lệ** trong INTENT_MAP.
@@ -80,10 +89,27 @@ def classify_intent(state: StateAgent) -> StateAgent:
         <intent_key>
 
         [USER QUERY]
-        {q}
         """
 
-        intent = llm.generate(system_prompt=system_prompt).strip().lower()
+def match_intent_rules(query: str):
+    """Return the first intent whose keywords appear in the query, or None."""
+    q = query.lower()
+    for intent, pattern in INTENT_RULES:
+        if pattern.search(q):
+            return intent
+    return None
+
+def has_student_id(query: str) -> bool:
+    """Cheap local check for an MSSV, without which no student lookup can run."""
+    return ("K" in query or "k" in query) and _MSSV_RE.search(query) is not None
+
+# Identify content api route
+async def classify_intent(state: StateAgent) -> StateAgent:
+    """Classify user intent with keyword rules, falling back to Gemini."""
+    try:
+        q = state["cleaned_query"]
+
+        intent = match_intent_rules(q) or await classify_intent_with_llm(q)
 
         return {
             "intent": intent,
@@ -96,11 +122,19 @@ def classify_intent(state: StateAgent) -> StateAgent:
         state['bot_reply'] += f"\nError while classifying intent: {e}"
     return state
 
+async def classify_intent_with_llm(q: str) -> str:
+    """Ask Gemini to pick the intent when no keyword rule matched."""
+    system_prompt = f"{_INTENT_PROMPT_PREFIX}{q}\n        "
+
+    return (await llm.agenerate(system_prompt=system_prompt)).strip().lower()
+
 
 def extract_student_id(state: StateAgent) -> StateAgent:
     """Extract student ID (MSSV) pattern like Kxxxxxxxxx."""
     try:
-        match = re.search(r"\bK\d{9}\b", state['cleaned_query'], re.IGNORECASE)
+        q = state['cleaned_query']
+        # str containment is a memchr-style scan; only run the regex when a K is present
+        match = _MSSV_RE.search(q) if ("K" in q or "k" in q) else None
         state['mssv'] = match.group(0).upper() if match else None
         state['bot_reply'] += f"\nMã số sinh viên: {state['mssv']}" if match else "\nKhông tìm thấy mã sinh viên"
     except Exception as e:
@@ -110,14 +144,18 @@ def extract_student_id(state: StateAgent) -> StateAgent:
         state['bot_reply'] += f"\nError while extracting student ID: {e}"
     return state
 
-def handle_student_query(state: StateAgent, function, desc: str): 
+async def handle_student_query(state: StateAgent, function, desc: str): 
     try: 
         mssv = state["mssv"]
         cleaned_query = state["cleaned_query"]
+        # find_one({"MASV": None}) would match any record missing MASV
+        if not mssv:
+            state["bot_reply"] += "\nError: Không có mã số sinh viên để tra cứu"
+            return state
 
-        data = function(mssv)
+        data = await function(mssv)
 
-        answer = llm.summarize(
+        answer = await llm.asummarize(
             context = f"Dữ liệu {desc} của sinh viên: {data}",
             question = cleaned_query    
         )
@@ -128,14 +166,14 @@ def handle_student_query(state: StateAgent, function, desc: str):
     return state
 
 # Specialized handlers per intent
-def handle_student_info(state: StateAgent) -> StateAgent:
-    return handle_student_query(state, db.get_student_data, "thông tin cá nhân")
+async def handle_student_info(state: StateAgent) -> StateAgent:
+    return await handle_student_query(state, db.get_student_data, "thông tin cá nhân")
 
-def handle_student_credit(state: StateAgent) -> StateAgent:
-    return handle_student_query(state, db.get_student_total_credits, "tín chỉ và môn học")
+async def handle_student_credit(state: StateAgent) -> StateAgent:
+    return await handle_student_query(state, db.get_student_total_credits, "tín chỉ và môn học")
 
-def handle_student_credit_semester(state: StateAgent) -> StateAgent:
-    return handle_student_query(state, db.get_student_credit_each_semester, "lịch học")
+async def handle_student_credit_semester(state: StateAgent) -> StateAgent:
+    return await handle_student_query(state, db.get_student_credit_each_semester, "lịch học")
 
 # Build graph
 graph = StateGraph(StateAgent)
@@ -169,9 +207,9 @@ graph.add_edge("handle_student_lesson", END)
 app = graph.compile()
 
 # Trigger langgraph
-def run_chatbot(query: str) -> str:
+async def run_chatbot(query: str) -> str:
     try:
-        result = app.invoke({"query": query})
+        result = await app.ainvoke({"query": query})
         return result["bot_reply"]
     except Exception as e:
         print("[Run_chatbot] Error:", e)
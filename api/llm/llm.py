@@ -1,12 +1,36 @@
-import google.generativeai as genai
+from google import genai
+from google.genai import types
+import httpx
 import os
 import traceback
 from dotenv import load_dotenv
 import json
+import orjson
 import re
+from pydantic import BaseModel
+
+# Response schemas: Gemini is asked for JSON matching these, so replies carry no prose to strip
+class DocumentMetadata(BaseModel):
+    title: str
+    keywords: list[str]
+
+class RagEvaluation(BaseModel):
+    is_sufficient: bool
+    reason: str
+    needs_student_data: bool
+
+# A follow-up with at least this many words, no pronoun pointing back at the history
+# and no leading conjunction is treated as standalone and searched without a rewrite
+STANDALONE_MIN_TOKENS = 6
+_ANAPHORA_RE = re.compile(r"\b(?:đó|này|kia|nó|he|she|it|that|this)\b", re.IGNORECASE)
+_LEADING_CONJ_RE = re.compile(r"^\s*(?:và|còn|then)\b", re.IGNORECASE)
 
 class ConnectLLM:
-    """Class quản lý việc kết nối và gọi đến Gemini LLM."""
+    """Class quản lý việc kết nối và gọi đến Gemini LLM.
+
+    Mỗi phương thức có hai phiên bản: đồng bộ (generate, summarize, ...) cho script/CLI
+    và bất đồng bộ với tiền tố "a" (agenerate, asummarize, ...) cho FastAPI/LangGraph.
+    """
 
     def __init__(self, model_name: str = "gemini-2.5-flash"):
         """Khởi tạo kết nối Gemini LLM."""
@@ -15,56 +39,110 @@ class ConnectLLM:
             api_key = os.getenv("GEMINI_API_KEY")
             if not api_key:
                 raise ValueError("GEMINI_API_KEY missing in .env file")
-            genai.configure(api_key=api_key)
-            self.model = genai.GenerativeModel(model_name)
+            self.model_name = model_name
+            # enhance_query hit rate: rewrites skipped as standalone / follow-ups seen
+            self.enhance_skipped = 0
+            self.enhance_followups = 0
+            # One client, and so one pooled HTTP connection set, shared by every call.
+            # An explicit httpx transport also keeps .aio on httpx: without one the SDK
+            # switches to aiohttp whenever it is importable, and the limits are ignored.
+            self.client = genai.Client(
+                api_key=api_key,
+                http_options=types.HttpOptions(
+                    async_client_args={
+                        "transport": httpx.AsyncHTTPTransport(
+                            limits=httpx.Limits(max_connections=100, max_keepalive_connections=100)
+                        )
+                    }
+                ),
+            )
             print(f"Gemini model '{model_name}' initialized successfully.")
         except Exception as e:
             print("Init Error!!! Failed to initialize Gemini API:", e)
             print(traceback.format_exc())
             raise
 
+    def _request(self, prompt: str = None, system_prompt: str = None) -> dict:
+        """Build generate_content kwargs; system_prompt alone is sent as the content."""
+        if prompt and system_prompt:
+            return {
+                "model": self.model_name,
+                "contents": prompt,
+                "config": types.GenerateContentConfig(system_instruction=system_prompt),
+            }
+        return {"model": self.model_name, "contents": system_prompt or prompt}
+
+    def _structured_request(self, prompt: str, schema: type[BaseModel]) -> dict:
+        """Build generate_content kwargs for a JSON reply constrained to schema."""
+        return {
+            "model": self.model_name,
+            "contents": prompt,
+            "config": types.GenerateContentConfig(response_mime_type="application/json", response_schema=schema),
+        }
+
+    @staticmethod
+    def _response_text(response) -> str:
+        if not response or not response.text:
+            return "No response from model."
+        return response.text.strip()
+
     def generate(self, prompt: str = None, system_prompt: str = None) -> str:
         """Sinh nội dung từ LLM dựa vào prompt đầu vào.
-        
+
         Thích hợp với hai trường hợp:
         1. Chỉ có prompt
-        2. Có system_prompt 
+        2. Có system_prompt
         """
         try:
-            if system_prompt:
-                response = self.model.generate_content(system_prompt)
-            elif prompt:
-                response = self.model.generate_content(prompt)
-            else:
+            if not (prompt or system_prompt):
                 return "No prompt provided."
-
-            if not response or not response.text:
-                return "No response from model."
-            return response.text.strip()
+            response = self.client.models.generate_content(**self._request(prompt, system_prompt))
+            return self._response_text(response)
         except Exception as e:
             print("[ConnectLLM.generate] Error:", e)
             print(traceback.format_exc())
             return f"Error generating content: {e}"
 
-    def summarize(self, context: str, question: str): 
-        try: 
-            prompt = f"""
+    async def agenerate(self, prompt: str = None, system_prompt: str = None) -> str:
+        """Phiên bản bất đồng bộ của generate."""
+        try:
+            if not (prompt or system_prompt):
+                return "No prompt provided."
+            response = await self.client.aio.models.generate_content(**self._request(prompt, system_prompt))
+            return self._response_text(response)
+        except Exception as e:
+            print("[ConnectLLM.agenerate] Error:", e)
+            print(traceback.format_exc())
+            return f"Error generating content: {e}"
+
+    @staticmethod
+    def _summarize_prompt(context: str, question: str) -> str:
+        return f"""
             Đây là dữ liệu đầy đủ về: {context}
             Câu hỏi của người dùng là: {question}
             Hãy trích xuất và trả lời ngắn gọn, chính xác nhất dựa trên dữ liệu.
-                    
+
             """
-            return self.generate(prompt)
-        except Exception as e: 
+
+    def summarize(self, context: str, question: str):
+        try:
+            return self.generate(self._summarize_prompt(context, question))
+        except Exception as e:
             print("[Summarize Error]", e)
             return f"Error summarizing content: {e}"
 
-    def enhance_query(self, current_query: str, history: list) -> str:
-        """
-        Rewrites the user query to be standalone based on chat history.
-        """
+    async def asummarize(self, context: str, question: str):
+        try:
+            return await self.agenerate(self._summarize_prompt(context, question))
+        except Exception as e:
+            print("[Summarize Error]", e)
+            return f"Error summarizing content: {e}"
+
+    @staticmethod
+    def _enhance_prompt(current_query: str, history: list):
+        """Build the rewrite prompt, or None when there is nothing to rewrite against."""
         if not history or not current_query.strip():
-            return current_query
+            return None
 
         # Handle both dict format {"user": ..., "bot": ...} and tuple format (user, bot)
         recent_history = history[-3:]
@@ -77,8 +155,8 @@ class ConnectLLM:
                 u, b = item
                 history_lines.append(f"User: {u}\nBot: {b}")
         history_str = "\n".join(history_lines)
-        
-        prompt = f"""
+
+        return f"""
         Rewrite the following question to be a standalone search query based on the history. Keep the language Vietnamese/English as input.
 
         History: {history_str}
@@ -88,6 +166,35 @@ class ConnectLLM:
         Standalone query:
         """
 
+    @staticmethod
+    def _is_standalone(query: str) -> bool:
+        """Heuristic: long enough, and nothing that refers back to earlier turns."""
+        return (
+            len(query.split()) >= STANDALONE_MIN_TOKENS
+            and not _ANAPHORA_RE.search(query)
+            and not _LEADING_CONJ_RE.search(query)
+        )
+
+    def _rewrite_prompt(self, current_query: str, history: list):
+        """Rewrite prompt for enhance_query, or None when the query can be searched as-is."""
+        prompt = self._enhance_prompt(current_query, history)
+        if prompt is None:
+            return None
+        self.enhance_followups += 1
+        if self._is_standalone(current_query):
+            self.enhance_skipped += 1
+            print(f"[Enhancer] Standalone query, rewrite skipped ({self.enhance_skipped}/{self.enhance_followups})")
+            return None
+        return prompt
+
+    def enhance_query(self, current_query: str, history: list) -> str:
+        """
+        Rewrites the user query to be standalone based on chat history.
+        """
+        prompt = self._rewrite_prompt(current_query, history)
+        if prompt is None:
+            return current_query
+
         try:
             result = self.generate(prompt)
             return result.strip() if result else current_query
@@ -95,11 +202,22 @@ class ConnectLLM:
             print(f"[Enhancer Error] {e}")
             return current_query
 
-    def generate_rag_answer(self, context: str, question: str) -> str:
-        """
-        Generate an answer based on RAG context and user question.
-        """
-        prompt = f"""
+    async def aenhance_query(self, current_query: str, history: list) -> str:
+        """Phiên bản bất đồng bộ của enhance_query."""
+        prompt = self._rewrite_prompt(current_query, history)
+        if prompt is None:
+            return current_query
+
+        try:
+            result = await self.agenerate(prompt)
+            return result.strip() if result else current_query
+        except Exception as e:
+            print(f"[Enhancer Error] {e}")
+            return current_query
+
+    @staticmethod
+    def _rag_prompt(context: str, question: str) -> str:
+        return f"""
         You are a university assistant. Answer based on the context below.
         If the answer is not in the context, say "I don't have that information".
 
@@ -109,49 +227,118 @@ class ConnectLLM:
         Question: {question}
         """
 
+    def generate_rag_answer(self, context: str, question: str) -> str:
+        """
+        Generate an answer based on RAG context and user question.
+        """
+        prompt = self._rag_prompt(context, question)
+
         try:
             return self.generate(prompt)
         except Exception as e:
             print(f"[RAG Generate Error] {e}")
             return f"Error: {e}"
 
-    def extract_document_metadata(self, text: str) -> dict:
+    async def agenerate_rag_answer(self, context: str, question: str) -> str:
+        """Phiên bản bất đồng bộ của generate_rag_answer, gom toàn bộ astream_rag_answer."""
+        try:
+            answer = "".join([chunk async for chunk in self.astream_rag_answer(context, question)]).strip()
+            return answer or "No response from model."
+        except Exception as e:
+            print(f"[RAG Generate Error] {e}")
+            return f"Error: {e}"
+
+    async def astream_rag_answer(self, context: str, question: str):
         """
-        Extract title and keywords from document text for RAG ingestion.
-        Returns dict with 'title' and 'keywords' keys.
+        Same as agenerate_rag_answer, but yields the answer in chunks as Gemini produces them.
+        Errors raise instead of being yielded as text, so a partial answer is never
+        mistaken for a complete one.
         """
-        prompt = f"""
+        request = self._request(self._rag_prompt(context, question))
+        async for chunk in await self.client.aio.models.generate_content_stream(**request):
+            if chunk.text:
+                yield chunk.text
+
+    @staticmethod
+    def _metadata_prompt(text: str) -> str:
+        # The JSON shape comes from the DocumentMetadata response_schema, not the prompt
+        return f"""
         Extract the title and 3 relevant keywords from the following text.
-        Return your answer in this exact JSON format:
-        {{"title": "extracted title", "keywords": ["keyword1", "keyword2", "keyword3"]}}
 
         Text:
         {text}
-
-        JSON:
         """
 
+    @staticmethod
+    def _extract_json(result: str):
+        """Parse the outermost {...} in the response (same span as a greedy DOTALL regex), or None."""
+        start = result.find("{")
+        end = result.rfind("}")
+        if start == -1 or end < start:
+            return None
+        raw = result[start:end + 1]
         try:
-            result = self.generate(prompt)
-            # Find JSON in the response
-            json_match = re.search(r'\{.*\}', result, re.DOTALL)
-            if json_match:
-                return json.loads(json_match.group())
-            return {"title": "", "keywords": []}
+            return orjson.loads(raw)
+        except orjson.JSONDecodeError:
+            # json accepts a few things orjson rejects (NaN, Infinity)
+            return json.loads(raw)
+
+    @staticmethod
+    def _parse_structured(response, schema: type[BaseModel]):
+        """The reply as a dict: the SDK-parsed schema object, else the JSON found in the text, else None."""
+        if response is None:
+            return None
+        if isinstance(response.parsed, schema):
+            return response.parsed.model_dump()
+        parsed = ConnectLLM._extract_json(response.text or "")
+        return schema.model_validate(parsed).model_dump() if parsed is not None else None
+
+    @staticmethod
+    def _parse_metadata(response) -> dict:
+        parsed = ConnectLLM._parse_structured(response, DocumentMetadata)
+        if parsed is not None:
+            return parsed
+        return {"title": "", "keywords": []}
+
+    def extract_document_metadata(self, text: str) -> dict:
+        """
+        Extract title and keywords from document text for RAG ingestion.
+        Returns dict with 'title' and 'keywords' keys.
+        """
+        try:
+            response = self.client.models.generate_content(
+                **self._structured_request(self._metadata_prompt(text), DocumentMetadata)
+            )
+            return self._parse_metadata(response)
         except Exception as e:
             print(f"[Metadata Extract Error] {e}")
             return {"title": "", "keywords": []}
 
-    def evaluate_rag_response(self, user_query: str, rag_response: str) -> dict:
+    async def aextract_document_metadata_strict(self, text: str) -> dict:
         """
-        Orchestration Agent: Evaluates if RAG response adequately answers the user query.
-        
-        Returns dict with:
-        - 'is_sufficient': bool - True if RAG response is good enough
-        - 'reason': str - Explanation of the decision
-        - 'needs_student_data': bool - True if query requires student-specific data lookup
+        Như aextract_document_metadata nhưng không nuốt lỗi: lỗi API (429, timeout, ...)
+        hoặc câu trả lời không đọc được sẽ raise, để ingest có thể thử lại sau.
         """
-        prompt = f"""You are an orchestration agent that evaluates chatbot responses.
+        response = await self.client.aio.models.generate_content(
+            **self._structured_request(self._metadata_prompt(text), DocumentMetadata)
+        )
+        parsed = self._parse_structured(response, DocumentMetadata)
+        if parsed is None:
+            raise ValueError("No metadata in model reply")
+        return parsed
+
+    async def aextract_document_metadata(self, text: str) -> dict:
+        """Phiên bản bất đồng bộ của extract_document_metadata."""
+        try:
+            return await self.aextract_document_metadata_strict(text)
+        except Exception as e:
+            print(f"[Metadata Extract Error] {e}")
+            return {"title": "", "keywords": []}
+
+    @staticmethod
+    def _evaluation_prompt(user_query: str, rag_response: str) -> str:
+        # The JSON shape comes from the RagEvaluation response_schema, not the prompt
+        return f"""You are an orchestration agent that evaluates chatbot responses.
 
         Analyze if the RAG response adequately answers the user's question.
 
@@ -169,24 +356,42 @@ class ConnectLLM:
         - Questions about credits, schedules, grades of a student
         - Personal student information lookup
 
-        Return your evaluation in this exact JSON format:
-        {{"is_sufficient": true/false, "reason": "brief explanation", "needs_student_data": true/false}}
+        Keep the reason to a brief explanation.
+        """
+
+    @staticmethod
+    def _parse_evaluation(response) -> dict:
+        # The schema guarantees all required keys exist
+        parsed = ConnectLLM._parse_structured(response, RagEvaluation)
+        if parsed is not None:
+            return parsed
+        return {"is_sufficient": False, "reason": "Failed to parse evaluation", "needs_student_data": False}
 
-        JSON:
+    def evaluate_rag_response(self, user_query: str, rag_response: str) -> dict:
         """
+        Orchestration Agent: Evaluates if RAG response adequately answers the user query.
 
+        Returns dict with:
+        - 'is_sufficient': bool - True if RAG response is good enough
+        - 'reason': str - Explanation of the decision
+        - 'needs_student_data': bool - True if query requires student-specific data lookup
+        """
         try:
-            result = self.generate(prompt)
-            json_match = re.search(r'\{.*\}', result, re.DOTALL)
-            if json_match:
-                parsed = json.loads(json_match.group())
-                # Ensure all required keys exist
-                return {
-                    "is_sufficient": parsed.get("is_sufficient", False),
-                    "reason": parsed.get("reason", ""),
-                    "needs_student_data": parsed.get("needs_student_data", False)
-                }
-            return {"is_sufficient": False, "reason": "Failed to parse evaluation", "needs_student_data": False}
+            response = self.client.models.generate_content(
+                **self._structured_request(self._evaluation_prompt(user_query, rag_response), RagEvaluation)
+            )
+            return self._parse_evaluation(response)
+        except Exception as e:
+            print(f"[Orchestration Error] {e}")
+            return {"is_sufficient": False, "reason": str(e), "needs_student_data": False}
+
+    async def aevaluate_rag_response(self, user_query: str, rag_response: str) -> dict:
+        """Phiên bản bất đồng bộ của evaluate_rag_response."""
+        try:
+            response = await self.client.aio.models.generate_content(
+                **self._structured_request(self._evaluation_prompt(user_query, rag_response), RagEvaluation)
+            )
+            return self._parse_evaluation(response)
         except Exception as e:
             print(f"[Orchestration Error] {e}")
-            return {"is_sufficient": False, "reason": str(e), "needs_student_data": False}
\ No newline at end of file
+            return {"is_sufficient": False, "reason": str(e), "needs_student_data": False}
@@ -1,16 +1,21 @@
+import asyncio
+from functools import lru_cache
 from langchain_google_genai import GoogleGenerativeAIEmbeddings
-from langchain_community.vectorstores import MongoDBAtlasVectorSearch
+from langchain_mongodb import MongoDBAtlasVectorSearch
 
 # Imports
-from config import get_config
+from api.rag.config import get_config
 from api.db import db
 from api.llm import llm
+from api.rag.query_cache import query_cache
 
-def _get_search_engine(cfg):
-    """Internal helper to get vector store for searching"""
+@lru_cache(maxsize=1)
+def _get_search_engine():
+    """Internal helper to get vector store for searching (built once, then reused)"""
+    cfg = get_config()
         
     return MongoDBAtlasVectorSearch(
-        collection=db.client[cfg["MONGODB_DB_NAME"]][cfg["MONGODB_RAG_COLLECTION_NAME"]],
+        collection=db.sync_client[cfg["MONGODB_DB_NAME"]][cfg["MONGODB_RAG_COLLECTION_NAME"]],
         embedding=GoogleGenerativeAIEmbeddings(
             model=cfg["EMBEDDING_MODEL_ID"],
             google_api_key=cfg["GEMINI_API_KEY"]
@@ -25,38 +30,141 @@ def enhance_query(current_query: str, history: list) -> str:
     """
     return llm.enhance_query(current_query, history)
 
-def answer_query(user_query: str, history: list = None, topk: int = 3):
+async def _asearch_by_vector(vs, vector, topk: int):
+    # Search with the vector we already have, so the query is embedded only once.
+    # The stored embedding is projected out server-side, so results (and the query cache) don't carry it
+    return await vs.asimilarity_search_by_vector(vector, k=topk)
+
+def _format_context(docs: list) -> str:
+    return "\n---\n".join([d.page_content for d in docs]) if docs else "No documents found."
+
+def _cacheable(answer: str, docs: list) -> bool:
+    # The RAG answer streams raise on failure, so an error chunk never ends up inside an answer
+    return bool(docs) and not answer.startswith(("Error", "No response from model."))
+
+def _same_query(original: str, rewritten: str) -> bool:
     """
-    Main RAG function.
-    Returns: (answer_string, source_documents)
+    True when the rewrite left the query unchanged (up to case and whitespace), so the raw
+    query's embedding can be reused. Near-identical rewrites often resolve a pronoun
+    ("của nó" -> "của UEL"), which is exactly what the search needs, so they don't count.
     """
-    cfg = get_config()
-        
-    # 1. Enhance
-    enhanced = enhance_query(user_query, history)
+    return " ".join(original.lower().split()) == " ".join(rewritten.lower().split())
+
+async def _aretrieve(user_query: str, history: list = None, topk: int = 3):
+    """
+    Enhance the query, check the query cache, then search the vector store.
+    The raw query is embedded while the rewrite is in flight, and that vector is
+    reused when the rewrite leaves the query unchanged.
+    Returns: (enhanced_query, query_vector, cached_hit, context_string, source_documents)
+    """
+    vs = None
+    try:
+        vs = _get_search_engine()
+    except Exception as e:
+        print(f"[RAG Error] DB Search: {e}")
+
+    raw_vector = None
+    if not history:
+        # Nothing to rewrite against, so the search query is known up front: check the
+        # cache before paying for an embedding
+        enhanced = user_query
+    elif vs:
+        enhanced, raw_vector = await asyncio.gather(
+            llm.aenhance_query(user_query, history),
+            vs.embeddings.aembed_query(user_query),
+            return_exceptions=True,
+        )
+        if isinstance(enhanced, BaseException):
+            print(f"[Enhancer Error] {enhanced}")
+            enhanced = user_query
+        if isinstance(raw_vector, BaseException):
+            print(f"[RAG Error] Embed: {raw_vector}")
+            raw_vector = None
+    else:
+        enhanced = await llm.aenhance_query(user_query, history)
     print(f"[RAG] Search Query: {enhanced}")
 
-    # 2. Search
+    hit = query_cache.get(enhanced)
+    if hit:
+        print("[RAG] Query cache hit (exact)")
+        return enhanced, None, hit, None, hit[1]
+
     docs = []
+    vector = None
     try:
-        vs = _get_search_engine(cfg)
         if vs:
-            docs = vs.similarity_search(enhanced, k=topk)
+            if raw_vector is not None and _same_query(user_query, enhanced):
+                vector = raw_vector
+            else:
+                vector = await vs.embeddings.aembed_query(enhanced)
+            hit = query_cache.get(enhanced, vector)
+            if hit:
+                print("[RAG] Query cache hit (semantic)")
+                return enhanced, vector, hit, None, hit[1]
+            docs = await _asearch_by_vector(vs, vector, topk)
     except Exception as e:
         print(f"[RAG Error] DB Search: {e}")
 
-    # 3. Generate
-    context = "\n---\n".join([d.page_content for d in docs]) if docs else "No documents found."
-    
+    return enhanced, vector, None, _format_context(docs), docs
+
+def answer_query(user_query: str, history: list = None, topk: int = 3):
+    """
+    Main RAG function, for scripts and the CLI: runs aanswer_query to completion,
+    so it must not be called from inside a running event loop.
+    Returns: (answer_string, source_documents)
+    """
+    return asyncio.run(aanswer_query(user_query, history, topk))
+
+async def aanswer_query(user_query: str, history: list = None, topk: int = 3):
+    """
+    Main RAG function: retrieve, then generate and cache the answer.
+    Returns: (answer_string, source_documents)
+    """
+    enhanced, vector, hit, context, docs = await _aretrieve(user_query, history, topk)
+    if hit:
+        return hit
+
     try:
-        answer = llm.generate_rag_answer(context, user_query)
+        answer = await llm.agenerate_rag_answer(context, user_query)
+        if _cacheable(answer, docs):
+            query_cache.put(enhanced, vector, answer, docs)
         return answer, docs
-    
+
     except Exception as e:
         return f"Error: {e}", []
 
+async def _acache_stream(chunks, enhanced: str, vector, docs: list):
+    """
+    Pass the streamed chunks through, caching the full answer once the stream ends.
+    A failed or abandoned stream never reaches the put, so partial answers aren't cached.
+    """
+    parts = []
+    async for chunk in chunks:
+        parts.append(chunk)
+        yield chunk
+    answer = "".join(parts)
+    if _cacheable(answer, docs):
+        query_cache.put(enhanced, vector, answer, docs)
+
+async def _aiter_one(text: str):
+    yield text
+
+async def astream_answer_query(user_query: str, history: list = None, topk: int = 3):
+    """
+    Streaming variant of aanswer_query.
+    Returns: (async_answer_chunk_iterator, source_documents)
+    """
+    enhanced, vector, hit, context, docs = await _aretrieve(user_query, history, topk)
+    if hit:
+        return _aiter_one(hit[0]), docs
+    return _acache_stream(llm.astream_rag_answer(context, user_query), enhanced, vector, docs), docs
+
 def ask(question: str, history: list = None):
     answer, docs = answer_query(question, history)
 
     return answer
 
+async def aask(question: str, history: list = None):
+    answer, docs = await aanswer_query(question, history)
+
+    return answer
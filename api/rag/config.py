@@ -1,9 +1,11 @@
 import os
+from functools import lru_cache
 from dotenv import load_dotenv
 from typing import Dict
 
 load_dotenv()
 
+@lru_cache(maxsize=1)
 def get_config() -> Dict[str, str]:
     """
     Centralized configuration for the RAG module.
@@ -21,6 +23,10 @@ def get_config() -> Dict[str, str]:
         "MONGODB_DB_NAME": os.getenv("MONGODB_DB_NAME", "chatbot_development"),
         "MONGODB_RAG_COLLECTION_NAME": os.getenv("MONGODB_RAG_COLLECTION_NAME", "pdf"),
         "MONGODB_RAG_INDEX_NAME": os.getenv("MONGODB_RAG_INDEX_NAME", "embedding"),
+
+        # --- Ingestion ---
+        "GEMINI_RPM": int(os.getenv("GEMINI_RPM", "120")),
+        "INGEST_CONCURRENCY": int(os.getenv("INGEST_CONCURRENCY", "8")),
     }
     # Validation
     if not cfg["GEMINI_API_KEY"]:
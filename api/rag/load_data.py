@@ -1,36 +1,50 @@
 import os
+import asyncio
 import glob
-import time
+import hashlib
+import json
 import pickle
+from functools import lru_cache
 
+from aiolimiter import AsyncLimiter
+
+from langchain_core.documents import Document
 from langchain_community.document_loaders import PyPDFLoader
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 from langchain_google_genai import GoogleGenerativeAIEmbeddings
-from langchain_community.vectorstores import MongoDBAtlasVectorSearch
+from langchain_mongodb import MongoDBAtlasVectorSearch
 
 # Local imports
-from config import get_config
+from api.rag.config import get_config
 
 # --- Initialize shared objects for standalone execution ---
 # These imports will initialize the llm and db objects
 from api.llm import llm
 from api.db import db
 
-# Ensure DB connection is established
-db.get_mongo_client()
-
 # --- CACHE FILES ---
 CACHE_DIR = os.path.dirname(os.path.abspath(__file__))
 CLEANED_PAGES_CACHE = os.path.join(CACHE_DIR, "cache_cleaned_pages.pkl")
 SPLIT_DOCS_CACHE = os.path.join(CACHE_DIR, "cache_split_docs.pkl")
-TAGGED_DOCS_CACHE = os.path.join(CACHE_DIR, "cache_tagged_docs.pkl")
+TAGGED_DOCS_CACHE = os.path.join(CACHE_DIR, "cache_tagged_docs.jsonl")
+# Pickled list of tagged Documents written by earlier versions, migrated on first run
+LEGACY_TAGGED_DOCS_CACHE = os.path.join(CACHE_DIR, "cache_tagged_docs.pkl")
+# Metadata keys produced by tagging; only these are checkpointed
+TAG_KEYS = ("title", "keywords")
+
+# Vector store upload: chunks per add_documents call, and calls in flight at once
+UPLOAD_BATCH_SIZE = 50
+UPLOAD_CONCURRENCY = 10
 
 # --- INTERNAL VECTOR LOGIC ---
-def _get_vector_store(cfg):
+@lru_cache(maxsize=1)
+def _get_vector_store():
+    """Vector store for ingestion, built once per process and then reused."""
+    cfg = get_config()
     if not db.client:
         raise ConnectionError("MongoDB connection failed - db.client is None")
     
-    collection = db.client[cfg["MONGODB_DB_NAME"]][cfg["MONGODB_RAG_COLLECTION_NAME"]]
+    collection = db.sync_client[cfg["MONGODB_DB_NAME"]][cfg["MONGODB_RAG_COLLECTION_NAME"]]
     embeddings = GoogleGenerativeAIEmbeddings(
         model=cfg["EMBEDDING_MODEL_ID"],
         google_api_key=cfg["GEMINI_API_KEY"]
@@ -41,24 +55,37 @@ def _get_vector_store(cfg):
         index_name=cfg["MONGODB_RAG_INDEX_NAME"]
     )
 
-def clear_and_upload(docs):
+async def clear_and_upload(docs):
     cfg = get_config()
     print("[Ingest] Connecting to MongoDB...")
     
     # 1. Clear old data
     if not db.client:
         raise ConnectionError("MongoDB connection failed - db.client is None")
-    db.client[cfg["MONGODB_DB_NAME"]][cfg["MONGODB_RAG_COLLECTION_NAME"]].delete_many({})
+    await db.client[cfg["MONGODB_DB_NAME"]][cfg["MONGODB_RAG_COLLECTION_NAME"]].delete_many({})
     print("[Ingest] Old collection cleared.")
 
-    # 2. Upload new
+    # 2. Upload new, several batches in flight so embedding and insert round trips overlap
     if not docs: return
-    try:
-        vs = _get_vector_store(cfg)
-        vs.add_documents(docs)
-        print(f"[Ingest] Successfully uploaded {len(docs)} chunks.")
-    except Exception as e:
-        print(f"[Ingest Error] Upload failed: {e}")
+    vs = _get_vector_store()
+    sem = asyncio.Semaphore(UPLOAD_CONCURRENCY)
+    limiter = AsyncLimiter(cfg["GEMINI_RPM"], 60)
+
+    async def upload(batch):
+        async with sem:
+            async with limiter:
+                await vs.aadd_documents(batch)
+        return len(batch)
+
+    results = await asyncio.gather(
+        *(upload(docs[i:i + UPLOAD_BATCH_SIZE]) for i in range(0, len(docs), UPLOAD_BATCH_SIZE)),
+        return_exceptions=True
+    )
+    for e in results:
+        if isinstance(e, Exception):
+            print(f"[Ingest Error] Upload failed: {e}")
+    uploaded = sum(n for n in results if isinstance(n, int))
+    print(f"[Ingest] Successfully uploaded {uploaded}/{len(docs)} chunks.")
 
 # --- PIPELINE STEPS ---
 
@@ -97,38 +124,97 @@ def process_documents(files):
     chunks = splitter.split_documents(cleaned)
     return chunks
 
-def extract_metadata(chunks):
+def _content_hash(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+def _migrate_legacy_tagged():
+    """Convert the old pickle checkpoint into JSONL records so its tags are not re-bought."""
+    if os.path.exists(TAGGED_DOCS_CACHE) or not os.path.exists(LEGACY_TAGGED_DOCS_CACHE):
+        return
+    try:
+        with open(LEGACY_TAGGED_DOCS_CACHE, "rb") as f: legacy = pickle.load(f)
+    except Exception as e:
+        print(f"[Ingest Warning] Could not read {LEGACY_TAGGED_DOCS_CACHE}: {e}")
+        return
+    migrated = 0
+    with open(TAGGED_DOCS_CACHE, "w", encoding="utf-8") as f:
+        for doc in legacy:
+            tags = {k: doc.metadata[k] for k in TAG_KEYS if k in doc.metadata}
+            # The old loop appended failed chunks untagged; leave those to be retried
+            if not tags.get("title") and not tags.get("keywords"):
+                continue
+            record = {"hash": _content_hash(doc.page_content), "tags": tags}
+            f.write(json.dumps(record, ensure_ascii=False, default=str) + "\n")
+            migrated += 1
+    print(f"[Ingest] Migrated {migrated}/{len(legacy)} tagged chunks from the pickle checkpoint.")
+
+def _load_tagged():
+    """Read the tagging checkpoint back as {page_content hash: tags}."""
+    done = {}
+    if not os.path.exists(TAGGED_DOCS_CACHE):
+        return done
+    with open(TAGGED_DOCS_CACHE, encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+                done[record["hash"]] = record["tags"]
+            except (ValueError, KeyError):
+                continue  # torn last line from an interrupted run, or an old index-keyed record
+    return done
+
+async def _tag_one(text, sem, limiter):
+    """Tag one chunk text, holding a concurrency slot and a Gemini rate-limit token."""
+    async with sem:
+        async with limiter:
+            # Strict variant: API failures raise instead of returning empty tags
+            meta = await llm.aextract_document_metadata_strict(text)
+    return {k: meta[k] for k in TAG_KEYS if k in meta}
+
+async def extract_metadata(chunks):
     """Extract metadata (title, keywords) from document chunks using shared llm object."""
+    cfg = get_config()
     
-    processed = []
-    # Resume cache logic
-    if os.path.exists(TAGGED_DOCS_CACHE):
-        try: 
-            with open(TAGGED_DOCS_CACHE, "rb") as f: processed = pickle.load(f)
-        except: pass
-    
-    start = len(processed)
-    print(f"[Ingest] Tagging {len(chunks) - start} chunks...")
-    
-    for i, doc in enumerate(chunks[start:], start=start):
-        try:
-            meta = llm.extract_document_metadata(doc.page_content)
-            doc.metadata.update(meta)
-            processed.append(doc)
-            
-            with open(TAGGED_DOCS_CACHE, "wb") as f: pickle.dump(processed, f)
-            if i % 5 == 0: print(f"Tagged {i+1}/{len(chunks)}")
-            time.sleep(0.5)
-        except Exception as e:
-            print(f"Error chunk {i}: {e}")
-            processed.append(doc)
-            
-    return processed
-
-def run_ingest():
+    # Resume from the append-only checkpoint: one JSON line per tagged text, keyed by
+    # its content hash so a rebuilt split cache never picks up another chunk's tags
+    _migrate_legacy_tagged()
+    done = _load_tagged()
+    hashes = [_content_hash(doc.page_content) for doc in chunks]
+    # Chunks sharing a text are tagged once; each keeps its own source metadata
+    pending = {h: doc.page_content for h, doc in zip(hashes, chunks) if h not in done}
+    print(f"[Ingest] Tagging {len(pending)} chunks...")
+
+    sem = asyncio.Semaphore(cfg["INGEST_CONCURRENCY"])
+    limiter = AsyncLimiter(cfg["GEMINI_RPM"], 60)
+    tagged = len(done)
+    completed = 0
+
+    with open(TAGGED_DOCS_CACHE, "a", encoding="utf-8") as checkpoint:
+        async def tag(h, text):
+            nonlocal completed
+            try:
+                tags = done[h] = await _tag_one(text, sem, limiter)
+                checkpoint.write(json.dumps({"hash": h, "tags": tags}, ensure_ascii=False, default=str) + "\n")
+                checkpoint.flush()
+            except Exception as e:
+                # Left out of the checkpoint, so the next run retries it
+                print(f"Error chunk {h[:12]}: {e}")
+            completed += 1
+            if completed % 5 == 0: print(f"Tagged {tagged + completed}/{tagged + len(pending)}")
+
+        await asyncio.gather(*(tag(h, text) for h, text in pending.items()))
+
+    return [
+        Document(page_content=doc.page_content, metadata={**doc.metadata, **done.get(h, {})})
+        for h, doc in zip(hashes, chunks)
+    ]
+
+async def run_ingest():
     files = get_pdf_files()
     if not files: return
 
+    # Ensure DB connection is established
+    await db.get_mongo_client()
+
     # Check cache for split docs
     if os.path.exists(SPLIT_DOCS_CACHE):
         with open(SPLIT_DOCS_CACHE, "rb") as f: chunks = pickle.load(f)
@@ -138,9 +224,9 @@ def run_ingest():
         with open(SPLIT_DOCS_CACHE, "wb") as f: pickle.dump(chunks, f)
 
     # Metadata & Upload
-    final_docs = extract_metadata(chunks)
-    clear_and_upload(final_docs)
+    final_docs = await extract_metadata(chunks)
+    await clear_and_upload(final_docs)
 
 if __name__ == "__main__":
-    run_ingest()
+    asyncio.run(run_ingest())
 
@@ -1,13 +1,18 @@
-from pymongo import MongoClient
-import os
-from dotenv import load_dotenv
+# check mongodb
+import asyncio
+from api.db import db
+from api.rag.config import get_config
 
-load_dotenv()
-client = MongoClient(os.getenv("MONGODB_URI"))
-db = client[os.getenv("MONGODB_DB_NAME")]
-collection = db[os.getenv("MONGODB_RAG_COLLECTION_NAME")]
+async def main():
+    # Reuse the shared MongoManager client instead of opening a separate connection
+    cfg = get_config()
+    await db.get_mongo_client()
+    collection = db.client[cfg["MONGODB_DB_NAME"]][cfg["MONGODB_RAG_COLLECTION_NAME"]]
 
-print("Tổng số documents:", collection.count_documents({}))
-doc = collection.find_one()
-print("Một mẫu document:\n", doc)
-# check mongodb
\ No newline at end of file
+    print("Tổng số documents:", await collection.count_documents({}))
+    doc = await collection.find_one()
+    print("Một mẫu document:\n", doc)
+    db.close_connection()
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,94 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+# --- CACHE SETTINGS ---
+QUERY_CACHE_SIZE = 512
+# Seconds an answer is served; bounds staleness after the documents are re-ingested
+QUERY_CACHE_TTL = 3600
+SIMILARITY_THRESHOLD = 0.95
+
+
+class QueryCache:
+    """
+    In-process LRU of answered RAG queries.
+    Exact hits are keyed on the sha256 of the normalized search query; semantic hits
+    compare the query embedding against the cached ones by cosine similarity.
+    """
+
+    def __init__(self, maxsize: int = QUERY_CACHE_SIZE, threshold: float = SIMILARITY_THRESHOLD,
+                 ttl: float = QUERY_CACHE_TTL):
+        self.maxsize = maxsize
+        self.threshold = threshold
+        self.ttl = ttl
+        self._entries = OrderedDict()   # key -> (unit vector or None, answer, docs, insert time)
+        self._matrix = None             # (keys, stacked vectors), rebuilt lazily after a put
+        self._lock = threading.Lock()   # the sync RAG path runs in the threadpool
+
+    @staticmethod
+    def _key(query: str) -> str:
+        normalized = " ".join(query.lower().split())
+        return hashlib.sha256(normalized.encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def _unit(vector):
+        v = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(v)
+        return v / norm if norm else None
+
+    def _vectors(self):
+        if self._matrix is None:
+            keys = [k for k, entry in self._entries.items() if entry[0] is not None]
+            vectors = np.stack([self._entries[k][0] for k in keys]) if keys else None
+            self._matrix = (keys, vectors)
+        return self._matrix
+
+    def _expire(self):
+        """Drop entries older than the TTL (LRU order isn't insertion order, so scan them all)."""
+        cutoff = time.monotonic() - self.ttl
+        expired = [k for k, entry in self._entries.items() if entry[3] < cutoff]
+        for k in expired:
+            del self._entries[k]
+        if expired:
+            self._matrix = None
+
+    def get(self, query: str, vector=None):
+        """Return the cached (answer, docs) for the query, or None on a miss."""
+        key = self._key(query)
+        with self._lock:
+            self._expire()
+            entry = self._entries.get(key)
+            if entry is None and vector is not None:
+                unit = self._unit(vector)
+                keys, vectors = self._vectors()
+                if unit is not None and keys:
+                    scores = vectors @ unit
+                    best = int(np.argmax(scores))
+                    if scores[best] >= self.threshold:
+                        key = keys[best]
+                        entry = self._entries[key]
+            if entry is None:
+                return None
+            self._entries.move_to_end(key)
+            return entry[1], entry[2]
+
+    def put(self, query: str, vector, answer: str, docs: list):
+        key = self._key(query)
+        unit = self._unit(vector) if vector is not None else None
+        with self._lock:
+            self._entries[key] = (unit, answer, docs, time.monotonic())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+            self._matrix = None
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._matrix = None
+
+
+query_cache = QueryCache()
@@ -2,19 +2,30 @@
 Script to embed PDF documents using Gemini embedding model and store in MongoDB Atlas.
 Uses MONGODB_URI2 and MONGO_DB_NAME2 for the connection.
 Includes text cleaning to improve embedding quality for Vietnamese text.
+Chunks are keyed by a hash of their text and metadata, so re-runs only embed new or changed chunks.
 """
 
+import asyncio
+import json
 import os
 import re
+import string
 import sys
-import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from aiolimiter import AsyncLimiter
+from blake3 import blake3
 from dotenv import load_dotenv
 from pypdf import PdfReader
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 from langchain_google_genai import GoogleGenerativeAIEmbeddings
-from langchain_mongodb import MongoDBAtlasVectorSearch
+from langchain.embeddings import CacheBackedEmbeddings
+from langchain.storage import LocalFileStore
 from langchain_core.documents import Document
-from pymongo import MongoClient
+from bson.binary import Binary, BinaryVectorDtype
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ReplaceOne
+from pymongo.operations import SearchIndexModel
 
 # Load environment variables
 load_dotenv()
@@ -27,9 +38,18 @@ COLLECTION_NAME = "pdf"
 EMBEDDING_MODEL = "models/text-embedding-004"
 INDEX_NAME = "vector_index"
 
+# Upload concurrency: chunks per batched embed request (the Gemini batch limit),
+# batches in flight at once, and Gemini embed requests per minute
+EMBED_BATCH_SIZE = 100
+EMBED_CONCURRENCY = 10
+EMBED_RPM = int(os.getenv("GEMINI_EMBED_RPM", "120"))
+
 # Data directory
 DATA_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data")
 
+# Local embedding cache (survives re-runs, even if the collection is dropped)
+EMBEDDING_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".emb_cache")
+
 
 def validate_config():
     """Validate that all required environment variables are set."""
@@ -46,30 +66,63 @@ def validate_config():
     print(f"  - Embedding Model: {EMBEDDING_MODEL}")
 
 
+# Lowercase Vietnamese letters, used to rejoin words split across lines
+VIETNAMESE_LOWER = r'a-zàáạảãâầấậẩẫăằắặẳẵèéẹẻẽêềếệểễìíịỉĩòóọỏõôồốộổỗơờớợởỡùúụủũưừứựửữỳýỵỷỹđ'
+# The same letters as sorted codepoints (the leading 'a-z' range expanded), for np.isin
+_VN_CODEPOINTS = np.array(
+    sorted({ord(c) for c in string.ascii_lowercase + VIETNAMESE_LOWER[len('a-z'):]}),
+    dtype=np.uint32
+)
+
+# clean_text patterns, compiled once for all PDFs
+_RE_WS = re.compile(r'[ \t]+')
+_RE_NL2 = re.compile(r'\n\s*\n')
+_RE_NL_TRIM = re.compile(r' *\n *')
+_RE_SINGLE_NL = re.compile(r'(?<!\n)\n(?!\n)')
+_RE_SPACES = re.compile(r' +')
+
+
+def join_split_words(text: str) -> str:
+    """
+    Replace each newline that sits between two lowercase Vietnamese letters with a space.
+    Works on the UTF-32 codepoint buffer so every position is tested in one vectorized pass.
+    """
+    if "\n" not in text:
+        return text
+    codes = np.frombuffer(text.encode("utf-32-le", "surrogatepass"), dtype=np.uint32).copy()
+    if codes.size < 3:
+        return text
+    letters = np.isin(codes, _VN_CODEPOINTS)
+    joins = np.flatnonzero(letters[:-2] & (codes[1:-1] == ord("\n")) & letters[2:]) + 1
+    if joins.size == 0:
+        return text
+    codes[joins] = ord(" ")
+    return codes.tobytes().decode("utf-32-le", "surrogatepass")
+
+
 def clean_text(text: str) -> str:
     """
     Clean PDF-extracted text by removing noise and normalizing whitespace.
     This significantly improves embedding quality for Vietnamese text.
     """
     # Replace multiple spaces/tabs with single space
-    text = re.sub(r'[ \t]+', ' ', text)
+    text = _RE_WS.sub(' ', text)
     
     # Replace multiple newlines with double newline (paragraph break)
-    text = re.sub(r'\n\s*\n', '\n\n', text)
+    text = _RE_NL2.sub('\n\n', text)
     
     # Remove spaces before/after newlines
-    text = re.sub(r' *\n *', '\n', text)
+    text = _RE_NL_TRIM.sub('\n', text)
     
     # Fix common PDF issues: rejoin words split by newlines
     # (lowercase Vietnamese letter followed by newline followed by lowercase letter)
-    vietnamese_lower = r'a-zàáạảãâầấậẩẫăằắặẳẵèéẹẻẽêềếệểễìíịỉĩòóọỏõôồốộổỗơờớợởỡùúụủũưừứựửữỳýỵỷỹđ'
-    text = re.sub(f'([{vietnamese_lower}])\n([{vietnamese_lower}])', r'\1 \2', text)
+    text = join_split_words(text)
     
     # Remove single newlines within paragraphs (but keep double newlines)
-    text = re.sub(r'(?<!\n)\n(?!\n)', ' ', text)
+    text = _RE_SINGLE_NL.sub(' ', text)
     
     # Clean up any remaining multiple spaces
-    text = re.sub(r' +', ' ', text)
+    text = _RE_SPACES.sub(' ', text)
     
     # Strip leading/trailing whitespace
     text = text.strip()
@@ -96,12 +149,8 @@ def get_pdf_files():
 def extract_text_from_pdf(filepath: str) -> str:
     """Extract text content from a PDF file."""
     reader = PdfReader(filepath)
-    text = ""
-    for page in reader.pages:
-        page_text = page.extract_text()
-        if page_text:
-            text += page_text + "\n"
-    return text
+    parts = [page.extract_text() for page in reader.pages]
+    return "".join([f"{part}\n" for part in parts if part])
 
 
 def load_and_split_documents():
@@ -112,35 +161,40 @@ def load_and_split_documents():
     total_chars_original = 0
     total_chars_cleaned = 0
     
-    for pdf_file in pdf_files:
-        filepath = os.path.join(DATA_DIR, pdf_file)
-        print(f"\n[Processing] {pdf_file}")
+    # Extract raw text from all PDFs in parallel (PDF parsing is CPU-bound)
+    with ProcessPoolExecutor(max_workers=os.cpu_count()) as executor:
+        extractions = [
+            executor.submit(extract_text_from_pdf, os.path.join(DATA_DIR, pdf_file))
+            for pdf_file in pdf_files
+        ]
+    
+        for pdf_file, extraction in zip(pdf_files, extractions):
+            print(f"\n[Processing] {pdf_file}")
         
-        try:
-            # Extract raw text
-            raw_text = extract_text_from_pdf(filepath)
-            total_chars_original += len(raw_text)
+            try:
+                raw_text = extraction.result()
+                total_chars_original += len(raw_text)
             
-            # Clean the text
-            cleaned_text = clean_text(raw_text)
-            total_chars_cleaned += len(cleaned_text)
+                # Clean the text
+                cleaned_text = clean_text(raw_text)
+                total_chars_cleaned += len(cleaned_text)
             
-            print(f"  - Extracted: {len(raw_text):,} chars → Cleaned: {len(cleaned_text):,} chars")
-            print(f"  - Noise removed: {len(raw_text) - len(cleaned_text):,} chars ({(1 - len(cleaned_text)/len(raw_text))*100:.1f}%)")
+                print(f"  - Extracted: {len(raw_text):,} chars → Cleaned: {len(cleaned_text):,} chars")
+                print(f"  - Noise removed: {len(raw_text) - len(cleaned_text):,} chars ({(1 - len(cleaned_text)/len(raw_text))*100:.1f}%)")
             
-            # Create a document with metadata
-            doc = Document(
-                page_content=cleaned_text,
-                metadata={
-                    "source": pdf_file,
-                    "filename": pdf_file,
-                    "type": "pdf"
-                }
-            )
-            documents.append(doc)
-        except Exception as e:
-            print(f"  - Error processing {pdf_file}: {e}")
-            continue
+                # Create a document with metadata
+                doc = Document(
+                    page_content=cleaned_text,
+                    metadata={
+                        "source": pdf_file,
+                        "filename": pdf_file,
+                        "type": "pdf"
+                    }
+                )
+                documents.append(doc)
+            except Exception as e:
+                print(f"  - Error processing {pdf_file}: {e}")
+                continue
     
     print(f"\n[Documents] Loaded {len(documents)} documents")
     print(f"[Cleaning] Total noise removed: {total_chars_original - total_chars_cleaned:,} chars")
@@ -159,117 +213,179 @@ def load_and_split_documents():
     return chunks
 
 
-def get_mongodb_client():
+async def get_mongodb_client():
     """Create MongoDB client connection."""
     try:
-        client = MongoClient(MONGODB_URI)
+        client = AsyncIOMotorClient(MONGODB_URI, maxPoolSize=100)
         # Test connection
-        client.admin.command('ping')
+        await client.admin.command('ping')
         print("[MongoDB] Successfully connected to MongoDB Atlas")
         return client
     except Exception as e:
         raise ConnectionError(f"Failed to connect to MongoDB: {e}")
 
 
-def clear_collection(client):
-    """Clear the existing collection."""
-    db = client[MONGODB_DB_NAME]
-    collection = db[COLLECTION_NAME]
+def chunk_id(chunk) -> str:
+    """
+    Stable document _id for a chunk: hash of its text, its metadata (source etc.) and the
+    embedding model. A metadata-only change gives a new id, so the document is rewritten.
+    """
+    key = json.dumps([chunk.page_content, chunk.metadata, EMBEDDING_MODEL], ensure_ascii=False, sort_keys=True, default=str)
+    return blake3(key.encode("utf-8")).hexdigest()
+
+
+async def sync_collection(chunks, client):
+    """
+    Drop stored chunks that are no longer produced and return only the chunks
+    (with their ids) that still need to be embedded.
+    """
+    collection = client[MONGODB_DB_NAME][COLLECTION_NAME]
+    
+    # Identical text from different sources gets one document per source (the embedding
+    # cache still embeds it once); only repeats within one source collapse to one document
+    by_id = {}
+    for chunk in chunks:
+        by_id.setdefault(chunk_id(chunk), chunk)
+    
+    stale = (await collection.delete_many({"_id": {"$nin": list(by_id)}})).deleted_count
+    existing = {doc["_id"] for doc in await collection.find({}, {"_id": 1}).to_list(None)}
+    new = [(doc_id, chunk) for doc_id, chunk in by_id.items() if doc_id not in existing]
     
-    count = collection.count_documents({})
-    if count > 0:
-        collection.delete_many({})
-        print(f"[MongoDB] Cleared {count} existing documents from '{COLLECTION_NAME}' collection")
-    else:
-        print(f"[MongoDB] Collection '{COLLECTION_NAME}' is already empty")
+    print(f"[MongoDB] Removed {stale} stale chunks, {len(existing)} unchanged, {len(new)} to embed")
+    return new
 
 
-def create_vector_index(client):
-    """Create vector search index if it doesn't exist."""
+# Atlas quantizes the stored float vectors to int8 for the ANN graph; full-fidelity
+# vectors stay on disk for rescoring, so recall is close to the float index
+VECTOR_INDEX_DEFINITION = {
+    "fields": [
+        {
+            "type": "vector",
+            "path": "embedding",
+            "numDimensions": 768,
+            "similarity": "cosine",
+            "quantization": "scalar"
+        }
+    ]
+}
+
+
+def index_matches(definition: dict) -> bool:
+    """True if an existing index definition already has every setting in VECTOR_INDEX_DEFINITION."""
+    fields = definition.get("fields", [])
+    wanted = VECTOR_INDEX_DEFINITION["fields"]
+    # Atlas may echo back extra defaults, so compare only the keys we set
+    return len(fields) == len(wanted) and all(
+        all(field.get(key) == value for key, value in want.items())
+        for field, want in zip(fields, wanted)
+    )
+
+
+async def create_vector_index(client):
+    """Create the vector search index, or update it if its definition is out of date."""
     db = client[MONGODB_DB_NAME]
     collection = db[COLLECTION_NAME]
     
     # Check if index exists
     try:
-        existing_indexes = list(collection.list_search_indexes())
-        index_exists = any(idx.get("name") == INDEX_NAME for idx in existing_indexes)
+        existing_indexes = await collection.list_search_indexes(INDEX_NAME).to_list(None)
     except Exception:
-        index_exists = False
+        existing_indexes = []
+    
+    if existing_indexes:
+        if index_matches(existing_indexes[0].get("latestDefinition", {})):
+            print(f"[MongoDB] Vector search index '{INDEX_NAME}' already exists")
+            return
+        try:
+            # e.g. an index created before scalar quantization was added; Atlas rebuilds it in place
+            await collection.update_search_index(INDEX_NAME, VECTOR_INDEX_DEFINITION)
+            print(f"[MongoDB] Updated vector search index '{INDEX_NAME}' (scalar quantization); Atlas rebuilds it in the background")
+        except Exception as e:
+            print(f"[MongoDB] Could not update vector search index '{INDEX_NAME}': {e}")
+            print(f"  Note: Update its definition in MongoDB Atlas UI to:\n  {json.dumps(VECTOR_INDEX_DEFINITION, indent=2)}")
+        return
     
-    if not index_exists:
-        print(f"[MongoDB] Vector search index '{INDEX_NAME}' not found.")
+    try:
+        await collection.create_search_index(
+            SearchIndexModel(definition=VECTOR_INDEX_DEFINITION, name=INDEX_NAME, type="vectorSearch")
+        )
+        print(f"[MongoDB] Created vector search index '{INDEX_NAME}' (scalar quantization); Atlas builds it in the background")
+    except Exception as e:
+        print(f"[MongoDB] Could not create vector search index '{INDEX_NAME}': {e}")
         print("  Note: Create the index in MongoDB Atlas UI with this config:")
         print(f"""
   Index Name: {INDEX_NAME}
   Index Definition:
-  {{
-    "fields": [
-      {{
-        "type": "vector",
-        "path": "embedding",
-        "numDimensions": 768,
-        "similarity": "cosine"
-      }}
-    ]
-  }}
+  {json.dumps(VECTOR_INDEX_DEFINITION, indent=2)}
         """)
-    else:
-        print(f"[MongoDB] Vector search index '{INDEX_NAME}' already exists")
 
 
-def embed_and_store(chunks, client):
-    """Embed document chunks and store in MongoDB."""
-    print("\n[Embedding] Initializing Gemini embedding model...")
-    
-    embeddings = GoogleGenerativeAIEmbeddings(
-        model=EMBEDDING_MODEL,
-        google_api_key=GEMINI_API_KEY
+def get_embeddings():
+    """Gemini embeddings behind a local cache keyed by chunk text and model."""
+    return CacheBackedEmbeddings.from_bytes_store(
+        GoogleGenerativeAIEmbeddings(
+            model=EMBEDDING_MODEL,
+            google_api_key=GEMINI_API_KEY
+        ),
+        LocalFileStore(EMBEDDING_CACHE_DIR),
+        namespace=EMBEDDING_MODEL,
+        batch_size=EMBED_BATCH_SIZE
     )
+
+
+def chunk_document(doc_id: str, chunk, vector) -> dict:
+    """
+    Stored document layout, the same one MongoDBAtlasVectorSearch reads: text, embedding, metadata fields.
+    The embedding is a packed float32 BSON vector rather than an array of 768 doubles.
+    """
+    embedding = Binary.from_vector(vector, BinaryVectorDtype.FLOAT32)
+    return {**chunk.metadata, "_id": doc_id, "text": chunk.page_content, "embedding": embedding}
+
+
+async def embed_and_store(chunks, client):
+    """Embed (id, chunk) pairs and upsert them into MongoDB by id, several batches at a time."""
+    print("\n[Embedding] Initializing Gemini embedding model...")
     
-    # Get collection
+    embeddings = get_embeddings()
     collection = client[MONGODB_DB_NAME][COLLECTION_NAME]
     
     print(f"[Embedding] Processing {len(chunks)} chunks...")
     
-    # Create vector store and add documents
-    vector_store = MongoDBAtlasVectorSearch(
-        collection=collection,
-        embedding=embeddings,
-        index_name=INDEX_NAME,
-        relevance_score_fn="cosine",
-        text_key="text"
-    )
-    
-    # Add documents in batches to avoid rate limits
-    batch_size = 10
+    sem = asyncio.Semaphore(EMBED_CONCURRENCY)
+    limiter = AsyncLimiter(EMBED_RPM, 60)
     total_added = 0
     
-    for i in range(0, len(chunks), batch_size):
-        batch = chunks[i:i + batch_size]
-        try:
-            vector_store.add_documents(batch)
-            total_added += len(batch)
-            print(f"  - Added batch {i // batch_size + 1}: {total_added}/{len(chunks)} chunks")
-        except Exception as e:
-            print(f"  - Error adding batch {i // batch_size + 1}: {e}")
-            # Wait and retry
-            time.sleep(2)
-            try:
-                vector_store.add_documents(batch)
-                total_added += len(batch)
-                print(f"  - Retry successful: {total_added}/{len(chunks)} chunks")
-            except Exception as e2:
-                print(f"  - Retry failed: {e2}")
-        
-        # Rate limiting
-        if (i + batch_size) < len(chunks):
-            time.sleep(0.5)
+    async def add_batch(batch_no, pairs):
+        nonlocal total_added
+        async with sem:
+            for attempt in range(2):
+                try:
+                    # One batched embed request per batch, then one bulk upsert
+                    async with limiter:
+                        vectors = await embeddings.aembed_documents([chunk.page_content for _, chunk in pairs])
+                    await collection.bulk_write([
+                        ReplaceOne({"_id": doc_id}, chunk_document(doc_id, chunk, vector), upsert=True)
+                        for (doc_id, chunk), vector in zip(pairs, vectors)
+                    ], ordered=False)
+                    total_added += len(pairs)
+                    print(f"  - Added batch {batch_no}: {total_added}/{len(chunks)} chunks")
+                    return
+                except Exception as e:
+                    print(f"  - Error adding batch {batch_no} (attempt {attempt + 1}): {e}")
+                    if attempt == 0:
+                        # Wait and retry once
+                        await asyncio.sleep(2)
+    
+    await asyncio.gather(*(
+        add_batch(i // EMBED_BATCH_SIZE + 1, chunks[i:i + EMBED_BATCH_SIZE])
+        for i in range(0, len(chunks), EMBED_BATCH_SIZE)
+    ))
     
     print(f"\n[Complete] Successfully embedded and stored {total_added} chunks")
     return total_added
 
 
-def main():
+async def main():
     """Main function to run the embedding pipeline."""
     print("=" * 60)
     print("PDF Embedding Pipeline for MongoDB Atlas RAG")
@@ -284,16 +400,16 @@ def main():
         chunks = load_and_split_documents()
         
         # Step 3: Connect to MongoDB
-        client = get_mongodb_client()
+        client = await get_mongodb_client()
         
-        # Step 4: Clear existing data
-        clear_collection(client)
+        # Step 4: Drop stale chunks, keep unchanged ones
+        new_chunks = await sync_collection(chunks, client)
         
         # Step 5: Create vector index (note: may need manual creation)
-        create_vector_index(client)
+        await create_vector_index(client)
         
         # Step 6: Embed and store
-        embed_and_store(chunks, client)
+        await embed_and_store(new_chunks, client)
         
         print("\n" + "=" * 60)
         print("Pipeline completed successfully!")
@@ -310,4 +426,4 @@ def main():
 
 
 if __name__ == "__main__":
-    main()
+    asyncio.run(main())
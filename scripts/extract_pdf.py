@@ -1,3 +1,4 @@
+from concurrent.futures import ProcessPoolExecutor
 from pypdf import PdfReader
 import os
 import json
@@ -5,25 +6,41 @@ import json
 data_dir = r"c:\Projects\Thesis-RAG-Langgraph-Assistant\data"
 output_file = r"c:\Projects\Thesis-RAG-Langgraph-Assistant\scripts\pdf_content.json"
 
-# Read all PDFs
-all_content = {}
-for filename in os.listdir(data_dir):
-    if filename.endswith('.pdf'):
-        filepath = os.path.join(data_dir, filename)
-        try:
-            reader = PdfReader(filepath)
-            text = ""
-            for page in reader.pages:
-                text += page.extract_text() or ""
-            all_content[filename] = text
-            print(f"Read: {filename} ({len(text)} chars)")
-        except Exception as e:
-            all_content[filename] = f"Error: {str(e)}"
-            print(f"Error reading {filename}: {e}")
-
-# Save to JSON
-with open(output_file, 'w', encoding='utf-8') as f:
-    json.dump(all_content, f, ensure_ascii=False, indent=2)
-
-print(f"\nSaved to {output_file}")
-print(f"Total files: {len(all_content)}")
+
+def read_pdf(filepath):
+    """Extract all page text from one PDF. Returns (text, error)."""
+    try:
+        reader = PdfReader(filepath)
+        return "".join([page.extract_text() or "" for page in reader.pages]), None
+    except Exception as e:
+        return None, e
+
+
+def main():
+    pdf_files = [filename for filename in os.listdir(data_dir) if filename.endswith('.pdf')]
+    filepaths = [os.path.join(data_dir, filename) for filename in pdf_files]
+
+    # Read all PDFs, one process per core (PDF parsing is CPU-bound), and write each
+    # entry as it arrives so only one document's text is held in memory at a time.
+    # The output matches json.dump(all_content, f, ensure_ascii=False, indent=2).
+    total = 0
+    with open(output_file, 'w', encoding='utf-8') as f, \
+            ProcessPoolExecutor(max_workers=os.cpu_count()) as executor:
+        f.write("{")
+        for filename, (text, error) in zip(pdf_files, executor.map(read_pdf, filepaths)):
+            if error is None:
+                print(f"Read: {filename} ({len(text)} chars)")
+            else:
+                text = f"Error: {str(error)}"
+                print(f"Error reading {filename}: {error}")
+            f.write(",\n  " if total else "\n  ")
+            f.write(f"{json.dumps(filename, ensure_ascii=False)}: {json.dumps(text, ensure_ascii=False)}")
+            total += 1
+        f.write("\n}" if total else "}")
+
+    print(f"\nSaved to {output_file}")
+    print(f"Total files: {total}")
+
+
+if __name__ == "__main__":
+    main()